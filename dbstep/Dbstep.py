@@ -14,13 +14,14 @@ from __future__ import print_function, absolute_import
 ###############################################################
 
 #Python Libraries
-import os, sys, time, shutil
+import os, sys, time, shutil, copy, io, contextlib
+from collections import namedtuple
 from glob import glob
 import numpy as np
 from optparse import OptionParser
 
-from dbstep import sterics, parse_data, calculator, writer
-from dbstep.constants import periodic_table, bondi, metals
+from dbstep import sterics, parse_data, calculator, writer, kernels
+from dbstep.constants import periodic_table, bondi, metals, GAS_CONSTANT
 
 class dbstep:
 	"""
@@ -30,6 +31,8 @@ class dbstep:
 			grid, onehot_grid, unocc_grud
 			L, Bmax, Bmin, 
 			occ_vol, bur_vol, bur_shell
+			isovals (isovalues of an --isoscan, the other parameters are then lists over them)
+			rows (R, bur_vol, bur_shell, Bmin, Bmax, L for each radius, as printed)
 			setup_time, calc_time
 
 	If steric scan is requested, Bmin and Bmax variables
@@ -38,32 +41,41 @@ class dbstep:
 	def __init__(self, *args, **kwargs):
 		self.file = args[0]
 		#QSAR specifications
-		self.dimensions, self.qsar_dir, self.interaction_energy = False, False, []
+		self.dimensions, self.qsar_dir, self.qsar_file, self.interaction_energy = False, False, False, []
 		#Grid Information
 		self.grid, self.unocc_grid, self.onehot_grid = False, False, False
 		#Sterimol Parameters
 		self.L, self.Bmin, self.Bmax = False, False, False
 		#Volume Parameters
 		self.occ_vol, self.bur_vol, self.bur_shell = False, False, False
+		#Isovalue scan
+		self.isovals = False
 		#Time Information
 		self.setup_time, self.calc_time = False, False
+		#Table of results
+		self.rows = []
 		
 		
 		if 'options' in kwargs:
 			self.options = kwargs['options']
 		else:
-			self.options = set_options(kwargs)
+			self.options = set_options({key: kwargs[key] for key in kwargs if key not in ['QSAR', 'voxel']})
 		if 'QSAR' in kwargs:
 			QSAR = kwargs['QSAR']
 		else: QSAR = False
 
 		file = self.file
 		options = self.options
+		# 0 leaves the thread count as it is, e.g. as set for each worker of a batch
+		if options.threads: kernels.set_threads(options.threads)
 
 		start = time.time()
 		spheres, cylinders = [], []
 		if isinstance(file,str):
-			name, ext = os.path.splitext(file)
+			name, ext = parse_data.split_ext(file)
+		elif isinstance(file, parse_data.DataParser):
+			name = str(file)
+			ext = 'parsed'
 		else:
 			name = file
 			ext = 'rdkit'
@@ -113,7 +125,7 @@ class dbstep:
 			mol.RADII = np.array(mol.RADII) * options.SCALE_VDW
 		elif options.surface == 'density':
 			if hasattr(mol, 'DENSITY'):
-				mol.DENSITY = np.array(mol.DENSITY)
+				mol.DENSITY = np.asarray(mol.DENSITY)
 				if options.verbose: print("\n   Read cube file {} containing {} points".format(file, mol.xdim * mol.ydim * mol.zdim))
 				[x_min, y_min, z_min] = np.array(mol.ORIGIN)
 				[x_max, y_max, z_max] = np.array(mol.ORIGIN) + np.array([(mol.xdim-1)* mol.SPACING, (mol.ydim-1) * mol.SPACING, (mol.zdim-1) * mol.SPACING])
@@ -179,6 +191,75 @@ class dbstep:
 			except:
 				print("   Can't read your scan request. Try something like --scan 3:5:0.25"); exit()
 
+		# a result cached for the same atoms, coordinates and settings replaces the grid and measurements
+		cache, cache_key, results = None, None, None
+		if options.cache and not options.qsar and not options.isoscan:
+			from dbstep.cache import ResultCache
+			cache = ResultCache(options.cache, options.cachesize)
+			cache_key = cache.key(mol, options)
+			results = cache.get(cache_key)
+		if results is None and options.isoscan:
+			results, setup_time = self._isoscan(mol, options, file, name, [x_min, x_max, y_min, y_max, z_min, z_max], origin, start)
+			self.isovals = results['isovals']
+		elif results is None:
+			results, setup_time = self._measure(mol, options, file, name, [x_min, x_max, y_min, y_max, z_min, z_max], 
+				origin, r_min, r_max, strip_width, r_intervals, start, kwargs.get('voxel'))
+			if cache is not None: cache.put(cache_key, results)
+		else:
+			setup_time = time.time() - start
+			if options.verbose: print("\n   Steric parameters for {} read from the cache in {}\n".format(file, options.cache))
+			self._print_header(options)
+			for row in results['rows']:
+				self._print_row(options, file, *row)
+		spheres += results['spheres']
+		self.rows = results['rows']
+		cylinders += results['cylinders']
+		L, Bmin, Bmax, bur_vol, bur_shell = results['L'], results['Bmin'], results['Bmax'], results['bur_vol'], results['bur_shell']
+
+		#for object reference
+		if options.measure == "grid":
+			self.occ_vol = results['occ_vol']
+		if options.sterimol: self.L = L
+		if options.scan == False:
+			if options.sterimol: 
+				self.Bmax = Bmax
+				self.Bmin = Bmin
+			if options.volume:
+				self.bur_vol = bur_vol
+				self.bur_shell = bur_shell
+		else:
+			if options.sterimol:
+				self.Bmax = results['Bmax_list']
+				self.Bmin = results['Bmin_list']
+			if options.volume:
+				self.bur_vol = results['bur_vol_list']
+				self.bur_shell = results['bur_shell_list']
+
+		# recompute L if a scan has been performed to get an overall L
+		if options.measure == 'grid' and r_intervals >1 and options.sterimol:
+			L = results['L_scan']
+			if not options.quiet:  print('\n   L parameter is {:5.2f} Ang'.format(L))
+		
+		if options.sterimol and not options.isoscan: cylinders.append('   CYLINDER, 0., 0., 0., 0., 0., {:5.3f}, 0.1, 1.0, 1.0, 1.0, 0., 0.0, 1.0,'.format(L))
+		
+		# Stop timing the loop
+		calc_time = time.time() - start - setup_time
+		# Report timing for the whole program and write a PyMol script
+		if options.timing == True and not options.quiet: 
+			print('   Timing: Setup {:5.1f} / Calculate {:5.1f} (secs)'.format(setup_time, calc_time))
+		self.setup_time = setup_time
+		self.calc_time = calc_time
+		if options.commandline == False and ext not in ['rdkit', 'parsed']:
+			writer.xyz_export(file,mol)
+			writer.pymol_export(file, mol, spheres, cylinders, options.isoval, options.visv, options.viss)
+
+	def _measure(self, mol, options, file, name, extents, origin, r_min, r_max, strip_width, r_intervals, start, voxel=None):
+		"""Builds the occupancy grid of a prepared (translated and rotated) molecule and measures the requested
+		steric parameters at each radius, printing a row for each. Returns a dictionary of the results and the setup time.
+		With the voxel engine a VoxelGrid can be passed to reuse its memory"""
+		[x_min, x_max, y_min, y_max, z_min, z_max] = extents
+		occ_vol = False
+
 		# Iterate over the grid points to see whether this is within VDW radius of any atom(s)
 		# Grid point occupancy is either yes/no (1/0)
 		# To save time this is currently done using a cuboid rather than cubic shaped-grid
@@ -194,79 +275,88 @@ class dbstep:
 				elif z_plus < z_max or z_minus > z_min:
 					sizeflag = False
 				if sizeflag:
-					n_x_vals = int(1 + round((x_plus - x_minus) / options.grid))
-					n_y_vals = int(1 + round((y_plus - y_minus)/ options.grid))
-					n_z_vals = int(1 + round((z_plus - z_minus) / options.grid))
-					x_vals = np.linspace(x_minus, x_plus, n_x_vals)
-					y_vals = np.linspace(y_minus, y_plus, n_y_vals)
-					z_vals = np.linspace(z_minus, z_plus, n_z_vals)
+					x_vals, y_vals, z_vals = sterics.grid_axes(x_minus, x_plus, y_minus, y_plus, z_minus, z_plus, options.grid)
 				else:
 					#sys exit
 					sys.exit("ERROR: Your molecule is larger than the gridsize you selected,\n"
 						"       please try again with a larger gridsize")
 			else:
-				n_x_vals = int(1 + round((x_max - x_min) / options.grid))
-				n_y_vals = int(1 + round((y_max - y_min) / options.grid))
-				n_z_vals = int(1 + round((z_max - z_min) / options.grid))
-				x_vals = np.linspace(x_min, x_max, n_x_vals)
-				y_vals = np.linspace(y_min, y_max, n_y_vals)
-				z_vals = np.linspace(z_min, z_max, n_z_vals)
+				x_vals, y_vals, z_vals = sterics.grid_axes(x_min, x_max, y_min, y_max, z_min, z_max, options.grid)
 			
 			if options.measure == 'grid':
 				# construct grid encapsulating molecule
-				grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
 				# compute which grid points occupy molecule
-				if options.qsar:
+				if options.engine == 'voxel':
+					# atoms are stamped into a boolean occupancy array, the returned VoxelGrid stands in for the KD-tree
+					# and occupied voxels come back as compact (i, j, k) indices rather than coordinates
+					if options.qsar:
+						occ_grid, unocc_grid, onehot_grid, point_tree, occ_vol = sterics.occupied_voxel(x_vals, y_vals, z_vals, mol.CARTESIANS, mol.RADII, origin, options)
+						grid = point_tree.points()
+					else:
+						occ_grid, point_tree, occ_vol = sterics.occupied_voxel(x_vals, y_vals, z_vals, mol.CARTESIANS, mol.RADII, origin, options, voxel)
+				elif options.qsar:
+					grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
 					occ_grid, unocc_grid, onehot_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
 				else:
+					grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
 					occ_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
 
 			if options.qsar:
-				if options.verbose: print("\n   Creating interaction energy grid xyz files in 'grid_"+name+"' directory")
 				probe = 'Ar'
-				path = os.getcwd()+'/grid_'+name+'/'
-				self.qsar_dir = path
-				if os.path.exists(path):
-					if options.verbose: print("   Overwriting: "+path)
-					shutil.rmtree(path)
-				os.mkdir(path)
-				
 				self.grid = grid
 				self.unocc_grid = unocc_grid
 				self.onehot_grid = onehot_grid
-				
-				for n, gridpoint in enumerate(unocc_grid):
-					self.interaction_energy.append(0.0)
-					xyzfile = open(path+'GRIDPOINT_'+probe+'_'+str(n)+'.xyz', 'w')
-					xyzfile.write(str(len(mol.ATOMTYPES)+1)+'\n')
-					xyzfile.write(path+'GRIDPOINT_'+probe+'_'+str(n)+'\n')
-
-					for i, atom in enumerate(mol.ATOMTYPES):
-						[x,y,z] = mol.CARTESIANS[i]
-						[gx,gy,gz] = gridpoint
-						xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(mol.ATOMTYPES[i], x,y,z))
-					xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(probe, gx,gy,gz))
-
-				xyzfile = open(path+'REF_'+probe+'.xyz', 'w')
-				xyzfile.write(str(len(mol.ATOMTYPES)+1)+'\n')
-				xyzfile.write('REF_'+probe+'\n')
-				for i, atom in enumerate(mol.ATOMTYPES):
-					[x,y,z] = mol.CARTESIANS[i]
-					[gx,gy,gz] = gridpoint
-
-					xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(mol.ATOMTYPES[i], x,y,z))
-				xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(probe,gx+100,gy+100,gz+100))
+				self.interaction_energy = [0.0] * len(unocc_grid)
+
+				if options.qsar_format == 'npz':
+					# the molecule once and the probe positions as an array, in a single file
+					path = os.getcwd()+'/grid_'+name+'.npz'
+					if options.verbose: print("\n   Writing the molecule and "+probe+" probe positions to '"+path+"'")
+					self.qsar_file = path
+					writer.qsar_export(path, mol, unocc_grid, probe)
+				else:
+					if options.verbose: print("\n   Creating interaction energy grid xyz files in 'grid_"+name+"' directory")
+					path = os.getcwd()+'/grid_'+name+'/'
+					self.qsar_dir = path
+					if os.path.exists(path):
+						if options.verbose: print("   Overwriting: "+path)
+						shutil.rmtree(path)
+					os.mkdir(path)
+
+					for n, gridpoint in enumerate(unocc_grid):
+						with open(path+'GRIDPOINT_'+probe+'_'+str(n)+'.xyz', 'w') as xyzfile:
+							xyzfile.write(str(len(mol.ATOMTYPES)+1)+'\n')
+							xyzfile.write(path+'GRIDPOINT_'+probe+'_'+str(n)+'\n')
+
+							for i, atom in enumerate(mol.ATOMTYPES):
+								[x,y,z] = mol.CARTESIANS[i]
+								[gx,gy,gz] = gridpoint
+								xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(mol.ATOMTYPES[i], x,y,z))
+							xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(probe, gx,gy,gz))
+
+					with open(path+'REF_'+probe+'.xyz', 'w') as xyzfile:
+						xyzfile.write(str(len(mol.ATOMTYPES)+1)+'\n')
+						xyzfile.write('REF_'+probe+'\n')
+						for i, atom in enumerate(mol.ATOMTYPES):
+							[x,y,z] = mol.CARTESIANS[i]
+							[gx,gy,gz] = gridpoint
+
+							xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(mol.ATOMTYPES[i], x,y,z))
+						xyzfile.write('{} {:10.5f} {:10.5f} {:10.5f}\n'.format(probe,gx+100,gy+100,gz+100))
 
 		elif options.surface == 'density':
 			x_vals = np.linspace(x_min, x_max, mol.xdim)
 			y_vals = np.linspace(y_min, y_max, mol.ydim)
 			z_vals = np.linspace(z_min, z_max, mol.zdim)
-			# writes a new grid to cube file
-			writer.WriteCubeData(name, mol)
-			# define the grid points containing the molecule
-			grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
-			# compute occupancy based on isodensity value applied to cube and remove points where there is no molecule
-			occ_grid, occ_vol, point_tree = sterics.occupied_dens(grid, mol.DENSITY, options)
+			# writes the translated and rotated cube for the PyMOL script, which is not written with --commandline
+			if not options.commandline: writer.WriteCubeData(name, mol)
+			# compute occupancy based on isodensity value applied to cube, the returned VoxelGrid holds it as a 
+			# boolean mask over the cube's own grid and occupied voxels come back as compact (i, j, k) indices.
+			# The grid is cropped to the occupied voxels (Sterimol) and to the largest sphere (buried volume)
+			radius = None
+			if options.volume:
+				radius = r_max + 0.5 * (options.vshell if options.vshell else strip_width)
+			occ_grid, point_tree, occ_vol = sterics.occupied_dens(x_vals, y_vals, z_vals, mol.DENSITY, options, radius)
 			
 			#adjust sizing of grid to fit sphere if necessary
 			if options.volume:
@@ -276,14 +366,35 @@ class dbstep:
 		setup_time = time.time() - start
 		# message user
 		if options.verbose: print("\n   Steric parameters will be generated in {} mode for {}\n".format(options.measure, file))
-		
-		if not options.quiet:
-			if options.volume and options.sterimol:
-				print("   {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format("R/Å", "%V_Bur", "%S_Bur", "Bmin", "Bmax", "L"))
-			elif options.volume:
-				print("   {:>6} {:>10} {:>10}".format("R/Å", "%V_Bur", "%S_Bur"))
+		self._print_header(options)
 
 		Bmin_list, Bmax_list, bur_vol_list, bur_shell_list = [], [], [], []
+		spheres, cylinders, rows = [], [], []
+		L, Bmin, Bmax, bur_vol, bur_shell = False, False, False, False, False
+
+		z_index = None
+		if options.sterimol and options.measure == 'grid':
+			# Sterimol parameters only depend on the outermost occupied voxels
+			ster_grid = occ_grid
+			if options.boundary:
+				if isinstance(point_tree, sterics.VoxelGrid):
+					ster_grid = point_tree.boundary_points()
+				else:
+					ster_grid = sterics.boundary_points(occ_grid)
+				if options.verbose: print("   Sterimol will be measured from {} boundary grid points.".format(len(ster_grid)))
+			elif isinstance(point_tree, sterics.VoxelGrid):
+				ster_grid = point_tree.cartesians(occ_grid)
+
+			# strips along the L-axis are taken as slices of the occupied points sorted by z
+			if r_intervals > 1 or options.pos:
+				ster_grid, z_index = sterics.sort_z(ster_grid)
+
+		# for a volume scan, distances of every grid point from the origin are sorted once 
+		# and the voxel counts for each radius are read from them
+		counts = None
+		if options.volume and r_intervals > 1:
+			shell_width = options.vshell if options.vshell else strip_width
+			counts = sterics.RadialCounts(occ_grid, point_tree, origin, r_max + 0.5 * shell_width)
 		
 		#Measure Sterimol or Volume 
 		for rad in np.linspace(r_min, r_max, r_intervals):
@@ -294,16 +405,16 @@ class dbstep:
 					bur_vol, bur_shell = 0.0,0.0
 				else:
 					if options.vshell: strip_width = options.vshell
-					bur_vol, bur_shell = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options)
+					bur_vol, bur_shell = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options, counts)
 				bur_vol_list.append(bur_vol)
 				bur_shell_list.append(bur_shell)
 			# Sterimol parameters can be obtained from VDW radii (classic) or from occupied voxels (new=default)
 			if options.sterimol:
 				if options.measure == 'grid':
-					L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, rad, options.grid, strip_width, options.pos)
+					L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(ster_grid, rad, options.grid, strip_width, options.pos, options.hull, options.increments, z_index)
 				elif options.measure == 'classic':
 					if options.surface == 'vdw':
-						L, Bmax, Bmin, cyl = sterics.get_classic_sterimol(mol.CARTESIANS, mol.RADII,mol.ATOMTYPES)
+						L, Bmax, Bmin, cyl = sterics.get_classic_sterimol(mol.CARTESIANS, mol.RADII,mol.ATOMTYPES, options.increments, options.hull)
 					elif options.surface == 'density':
 						print("   Can't use classic Sterimol with the isodensity surface. Either use VDW radii (--surface vdw) or use grid Sterimol (--sterimol grid)"); exit()
 				Bmin_list.append(Bmin)
@@ -314,55 +425,109 @@ class dbstep:
 					cylinders.append(c)
 	
 			# Tabulate result
-			if options.volume and options.sterimol:
+			if options.volume:
 				# for pymol visualization
 				spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f},".format(rad))
-				if not options.quiet: print("   {:6.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell, Bmin, Bmax, L))
-			elif options.volume:
-				spheres.append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f},".format(rad))
-				if not options.quiet: print("   {:6.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell))
-			elif options.sterimol:
-				if not options.scan:
-					if not options.quiet: print("   {} / Bmin: {:5.2f} / Bmax: {:5.2f} / L: {:5.2f}".format(file, Bmin, Bmax, L))
-				else:
-					if not options.quiet: print("   {} / R: {:5.2f} / Bmin: {:5.2f} / Bmax: {:5.2f} ".format(file, rad, Bmin, Bmax))
+			rows.append([float(rad), bur_vol, bur_shell, Bmin, Bmax, L])
+			self._print_row(options, file, *rows[-1])
 
-		#for object reference
-		if options.measure == "grid":
-			self.occ_vol = occ_vol
-		if options.sterimol: self.L = L
-		if options.scan == False:
-			if options.sterimol: 
-				self.Bmax = Bmax
-				self.Bmin = Bmin
+		# overall L if a scan has been performed
+		L_scan = False
+		if options.measure == 'grid' and r_intervals >1 and options.sterimol:
+			# occupied points are sorted by z, so the overall L is the last of them
+			L_scan = z_index[-1] if len(z_index) > 0 else 0
+
+		results = {'L': L, 'Bmin': Bmin, 'Bmax': Bmax, 'bur_vol': bur_vol, 'bur_shell': bur_shell, 'occ_vol': occ_vol,
+			'Bmin_list': Bmin_list, 'Bmax_list': Bmax_list, 'bur_vol_list': bur_vol_list, 'bur_shell_list': bur_shell_list,
+			'L_scan': L_scan, 'rows': rows, 'spheres': spheres, 'cylinders': cylinders}
+		return results, setup_time
+
+	def _isoscan(self, mol, options, file, name, extents, origin, start):
+		"""Measures the steric parameters of a prepared (translated and rotated) density cube at each isovalue of
+		options.isoscan ('min:max:step') at a single radius, so the cube is parsed and aligned once for the whole range.
+		The occupied volume at every isovalue is read from the densities sorted once, and the occupancy of the cropped 
+		grid is the density thresholded again for each isovalue. Prints a row for each isovalue and returns a dictionary 
+		of the results (lists over the isovalues) and the setup time"""
+		if options.surface != 'density':
+			sys.exit("   An isovalue scan (--isoscan) needs a density cube and --surface density")
+		if options.scan:
+			sys.exit("   An isovalue scan (--isoscan) is measured at a single radius (-r) and can't be combined with --scan")
+		if options.sterimol and options.measure == 'classic':
+			print("   Can't use classic Sterimol with the isodensity surface. Either use VDW radii (--surface vdw) or use grid Sterimol (--sterimol grid)"); exit()
+		try:
+			[iso_min, iso_max, iso_step] = [float(iso) for iso in str(options.isoscan).split(':')]
+			isovals = np.linspace(iso_min, iso_max, int(round((iso_max - iso_min) / iso_step)) + 1)
+		except:
+			print("   Can't read your isovalue scan request. Try something like --isoscan 0.001:0.01:0.001"); exit()
+
+		[x_min, x_max, y_min, y_max, z_min, z_max] = extents
+		x_vals = np.linspace(x_min, x_max, mol.xdim)
+		y_vals = np.linspace(y_min, y_max, mol.ydim)
+		z_vals = np.linspace(z_min, z_max, mol.zdim)
+		# writes the translated and rotated cube for the PyMOL script, which is not written with --commandline
+		if not options.commandline: writer.WriteCubeData(name, mol)
+		dens = np.reshape(mol.DENSITY, (mol.xdim, mol.ydim, mol.zdim))
+
+		# number of voxels above each isovalue from the sorted densities of the whole cube
+		ordered = np.sort(dens, axis=None)
+		occ_vols = (ordered.size - np.searchsorted(ordered, isovals, side='right')) * options.grid ** 3
+		# the grid is cropped to the region that is occupied at the lowest isovalue, which holds every other
+		strip_width = options.vshell if options.vshell else 0.0
+		radius = options.radius + 0.5 * strip_width if options.volume else None
+		block = sterics.density_roi(x_vals, y_vals, z_vals, dens > isovals.min(), radius, options.sterimol)
+		voxel = sterics.VoxelGrid(x_vals[block[0]], y_vals[block[1]], z_vals[block[2]])
+		dens = dens[block]
+
+		setup_time = time.time() - start
+		if options.verbose: print("\n   Steric parameters will be generated for {} isovalues of {}\n".format(len(isovals), file))
+		columns = ["Isoval", "Vol/Å^3"]
+		if options.volume: columns += ["%V_Bur", "%S_Bur"]
+		if options.sterimol: columns += ["Bmin", "Bmax", "L"]
+		if not options.quiet: print("   {:>10}".format(columns[0]) + "".join(" {:>10}".format(column) for column in columns[1:]))
+
+		results = {'isovals': [float(iso) for iso in isovals], 'occ_vol': [float(vol) for vol in occ_vols], 'L': [], 'Bmin': [], 'Bmax': [], 
+			'bur_vol': [], 'bur_shell': [], 'rows': [], 'spheres': [], 'cylinders': []}
+		for isoval, occ_vol in zip(isovals, occ_vols):
+			np.greater(dens, isoval, out=voxel.mask)
+			L, Bmin, Bmax, bur_vol, bur_shell = False, False, False, False, False
+			values = [isoval, occ_vol]
 			if options.volume:
-				self.bur_vol = bur_vol
-				self.bur_shell = bur_shell
-		else:
+				bur_vol, bur_shell = sterics.buried_vol(None, voxel, origin, options.radius, strip_width, options)
+				values += [bur_vol, bur_shell]
 			if options.sterimol:
-				self.Bmax = Bmax_list
-				self.Bmin = Bmin_list 
-			if options.volume:
-				self.bur_vol = bur_vol_list
-				self.bur_shell = bur_shell_list
+				ster_grid = voxel.boundary_points() if options.boundary else voxel.occupied_points()
+				z_index = None
+				if options.pos: ster_grid, z_index = sterics.sort_z(ster_grid)
+				L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(ster_grid, options.radius, options.grid, strip_width, options.pos, options.hull, options.increments, z_index)
+				values += [Bmin, Bmax, L]
+			for key, value in zip(['L', 'Bmin', 'Bmax', 'bur_vol', 'bur_shell'], [L, Bmin, Bmax, bur_vol, bur_shell]):
+				results[key].append(value)
+			results['rows'].append([float(options.radius), bur_vol, bur_shell, Bmin, Bmax, L])
+			if not options.quiet: print("   {:10.5f}".format(values[0]) + "".join(" {:10.2f}".format(value) for value in values[1:]))
 
-		# recompute L if a scan has been performed to get an overall L
-		if options.measure == 'grid' and r_intervals >1 and options.sterimol:
-			L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, rad, options.grid, 0.0)
-			if not options.quiet:  print('\n   L parameter is {:5.2f} Ang'.format(L))
-		
-		if options.sterimol: cylinders.append('   CYLINDER, 0., 0., 0., 0., 0., {:5.3f}, 0.1, 1.0, 1.0, 1.0, 0., 0.0, 1.0,'.format(L))
-		
-		# Stop timing the loop
-		calc_time = time.time() - start - setup_time
-		# Report timing for the whole program and write a PyMol script
-		if options.timing == True and not options.quiet: 
-			print('   Timing: Setup {:5.1f} / Calculate {:5.1f} (secs)'.format(setup_time, calc_time))
-		self.setup_time = setup_time
-		self.calc_time = calc_time
-		if options.commandline == False and ext != 'rdkit':
-			writer.xyz_export(file,mol)
-			writer.pymol_export(file, mol, spheres, cylinders, options.isoval, options.visv, options.viss)
+		if options.volume: results['spheres'].append("   SPHERE, 0.000, 0.000, 0.000, {:5.3f},".format(options.radius))
+		return results, setup_time
+
+	def _print_header(self, options):
+		"""Prints the column headings of a volume table"""
+		if not options.quiet:
+			if options.volume and options.sterimol:
+				print("   {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format("R/Å", "%V_Bur", "%S_Bur", "Bmin", "Bmax", "L"))
+			elif options.volume:
+				print("   {:>6} {:>10} {:>10}".format("R/Å", "%V_Bur", "%S_Bur"))
+
+	def _print_row(self, options, file, rad, bur_vol, bur_shell, Bmin, Bmax, L):
+		"""Prints the results for one radius"""
+		if options.quiet: return
+		if options.volume and options.sterimol:
+			print("   {:6.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell, Bmin, Bmax, L))
+		elif options.volume:
+			print("   {:6.2f} {:10.2f} {:10.2f}".format(rad, bur_vol, bur_shell))
+		elif options.sterimol:
+			if not options.scan:
+				print("   {} / Bmin: {:5.2f} / Bmax: {:5.2f} / L: {:5.2f}".format(file, Bmin, Bmax, L))
+			else:
+				print("   {} / R: {:5.2f} / Bmin: {:5.2f} / Bmax: {:5.2f} ".format(file, rad, Bmin, Bmax))
 
 	def _get_spec_atoms(self, options):
 		"""Gets the specification atoms from input or sets the defaults."""
@@ -409,6 +574,225 @@ class dbstep:
 				sys.exit(f"{num_atoms} atom(s) found in {file}, should have at least {min_atoms} atom(s) for {calculation} calculation.")
 
 
+def trajectory(file, **kwargs):
+	"""
+	Steric parameters of each frame of a multi-frame xyz file, e.g. an MD or IRC trajectory or a CREST
+	conformer ensemble. Frames are read and measured one at a time, so the file is never held in memory,
+	and a dbstep object is yielded for each frame as soon as it has been measured. Unless quiet, a row of 
+	results is printed for each frame as it completes (the full output of each frame for a scan). 
+	With --engine voxel the occupancy grid of one frame is reused for the next.
+
+	Args:
+		file (str): path to the xyz file
+		any dbstep option as a keyword argument (or options=)
+
+	Yields:
+		dbstep object of each frame
+	"""
+	if 'options' in kwargs:
+		options = kwargs['options']
+	else:
+		options = set_options(kwargs)
+	voxel = sterics.VoxelGrid([], [], [])
+	name = parse_data.split_ext(os.path.basename(file))[0]
+	columns = []
+	if options.sterimol: columns += ['Bmin', 'Bmax', 'L']
+	if options.volume or options.vshell: columns += ['bur_vol', 'bur_shell']
+	for n, (comment, atoms, coords) in enumerate(parse_data.iter_xyz_frames(file)):
+		frame = parse_data.ArrayParser(atoms, coords, '{} frame {}'.format(name, n + 1))
+		frame_options = copy.deepcopy(options)
+		if not options.scan: frame_options.quiet = True
+		mol = dbstep(frame, options=frame_options, voxel=voxel)
+		if not options.quiet and not options.scan:
+			headings = {'Bmin': 'Bmin', 'Bmax': 'Bmax', 'L': 'L', 'bur_vol': '%V_Bur', 'bur_shell': '%S_Bur'}
+			if n == 0: print("   {:>8} ".format("Frame") + " ".join("{:>10}".format(headings[column]) for column in columns))
+			print("   {:>8} ".format(n + 1) + " ".join("{:10.2f}".format(getattr(mol, column)) for column in columns), flush=True)
+		yield mol
+
+
+class ensemble:
+	"""
+	Steric parameters of every conformer of a molecule, or of every (selected) geometry of an optimization or 
+	scan output file. The conformers are parsed together and aligned in one vectorized rotation, then each
+	is measured on its own grid, so its results are those of a separate dbstep run. With --engine voxel 
+	the memory of the grid is reused from one conformer to the next.
+
+	Args:
+		mol: RDKit mol object with embedded conformers, a list of atom symbols (then coords is required)
+			or the path of an output file read by cclib, whose geometries are selected with steps (default all)
+		coords (array, optional): (n_conf, n_atoms, 3) coordinates of each conformer
+		energies (array, optional): conformer energies in kcal/mol, for Boltzmann weighted averages
+		temperature (float, optional): temperature in K for the Boltzmann weights (default 298.15)
+		any dbstep option as a keyword argument (or options=)
+
+	Objects that can currently be referenced are:
+			conformers (dbstep object of each conformer)
+			labels (name of each conformer, for an output file the index of each geometry in it)
+			L, Bmax, Bmin, occ_vol, bur_vol, bur_shell (numpy arrays with a value, or scan, for each conformer)
+			weights (Boltzmann weights, None without energies)
+			min, max, mean, boltzmann (dictionaries of the aggregate of each parameter over the conformers)
+	"""
+	def __init__(self, mol, coords=None, energies=None, temperature=298.15, **kwargs):
+		if 'options' in kwargs:
+			options = copy.deepcopy(kwargs['options'])
+		else:
+			options = set_options(kwargs)
+		dbstep._get_spec_atoms(self, options)
+		if options.vshell: options.volume = True
+		if options.volume: options.measure = 'grid'
+
+		# atoms are removed (noH, exclude) once for the whole ensemble
+		if isinstance(mol, str):
+			steps = options.steps if options.steps else 'all'
+			parsed = parse_data.cclibParser(mol, parse_data.split_ext(mol)[1][1:], options.noH, options.exclude, 
+				options.spec_atom_1, options.spec_atom_2, steps=steps)
+			name = parse_data.split_ext(os.path.basename(mol))[0]
+			self.labels = ['{} step {}'.format(name, step) for step in parsed.STEPS]
+		else:
+			if coords is None:
+				atoms, coords = parse_data.rdkit_conformers(mol)
+			else:
+				atoms = list(mol)
+			coords = np.asarray(coords, dtype=float).reshape(-1, len(atoms), 3)
+			parsed = parse_data.ArrayParser(atoms, coords, 'ensemble', options.noH, options.exclude, options.spec_atom_1, options.spec_atom_2)
+			self.labels = ['conformer {}'.format(n + 1) for n in range(len(coords))]
+		options.spec_atom_1, options.spec_atom_2 = parsed.spec_atom_1, parsed.spec_atom_2
+		options.noH, options.exclude = False, False
+		# every conformer is translated (and rotated for Sterimol) at once, the conformers are then measured as they are
+		coords = calculator.align_ensemble(parsed.CARTESIANS, options.spec_atom_1, options.spec_atom_2,
+			options.atom3, options.sterimol and not options.norot)
+		options.norot = True
+
+		# each conformer's grid is sized to that conformer, the voxel engine reuses one occupancy array for all of them
+		voxel = sterics.VoxelGrid([], [], []) if options.engine == 'voxel' else None
+
+		self.conformers = []
+		for label, conf in zip(self.labels, coords):
+			conformer = parse_data.ArrayParser(parsed.ATOMTYPES, conf, label, 
+				spec_atom_1=options.spec_atom_1, spec_atom_2=options.spec_atom_2)
+			self.conformers.append(dbstep(conformer, options=copy.deepcopy(options), voxel=voxel))
+		self.options = options
+
+		# per-conformer arrays and their aggregates
+		params = []
+		if options.sterimol: params += ['L', 'Bmin', 'Bmax']
+		if options.measure == 'grid': params += ['occ_vol']
+		if options.volume: params += ['bur_vol', 'bur_shell']
+		self.L, self.Bmin, self.Bmax, self.occ_vol, self.bur_vol, self.bur_shell = False, False, False, False, False, False
+		for param in params:
+			setattr(self, param, np.array([getattr(conformer, param) for conformer in self.conformers], dtype=float))
+		self.weights = None
+		if energies is not None:
+			energies = np.asarray(energies, dtype=float)
+			self.weights = np.exp(-(energies - np.min(energies)) / (GAS_CONSTANT * temperature))
+			self.weights /= np.sum(self.weights)
+		self.min = {param: np.min(getattr(self, param), axis=0) for param in params}
+		self.max = {param: np.max(getattr(self, param), axis=0) for param in params}
+		self.mean = {param: np.mean(getattr(self, param), axis=0) for param in params}
+		self.boltzmann = {param: np.tensordot(self.weights, getattr(self, param), axes=1) if self.weights is not None else None for param in params}
+
+		if not options.quiet and not options.scan:
+			print("\n   Ensemble of {} structures".format(len(self.conformers)))
+			print("   {:>10} {:>10} {:>10} {:>10} {:>10}".format("", "min", "max", "mean", "Boltzmann"))
+			for param in params:
+				boltzmann = "{:10.2f}".format(self.boltzmann[param]) if self.weights is not None else "{:>10}".format("-")
+				print("   {:>10} {:10.2f} {:10.2f} {:10.2f} {}".format(param, self.min[param], self.max[param], self.mean[param], boltzmann))
+
+
+class multisite:
+	"""
+	Steric parameters at several sites (attachment points) of one molecule, e.g. each ligand around a metal
+	or each substituent of a scaffold, from a single call. The input is parsed once, and sites that share a frame 
+	(the same atom1 and, when the molecule is rotated for Sterimol or atoms are removed, the same atom2 and atom3) 
+	share a single occupancy grid and measurement.
+
+	Args:
+		file: input file name or RDKit mol object, as for dbstep
+		sites: list of (atom1, atom2[, atom3]) for each site (atom2 may be a list of atoms), or a string of
+			sites separated by ';' with each site as atom1:atom2[:atom3], e.g. '1:2;5:6,7;9:10:11'
+		any dbstep option as a keyword argument (or options=)
+
+	Objects that can currently be referenced are:
+			sites (atom1, atom2 and atom3 of each site)
+			results (dbstep object of each site, the same object for sites sharing a frame)
+			L, Bmax, Bmin, occ_vol, bur_vol, bur_shell (numpy arrays with a value, or scan, for each site)
+	"""
+	def __init__(self, file, sites, **kwargs):
+		if 'options' in kwargs:
+			options = copy.deepcopy(kwargs['options'])
+		else:
+			options = set_options(kwargs)
+		if options.vshell: options.volume = True
+		if options.volume: options.measure = 'grid'
+
+		if isinstance(sites, str):
+			sites = [site.split(':') for site in sites.replace(' ', ';').split(';') if site]
+		self.sites = []
+		for site in sites:
+			if len(site) not in [2, 3]:
+				sys.exit("   Can't read site {}, give each site as atom1:atom2 or atom1:atom2:atom3".format(site))
+			site_options = copy.deepcopy(options)
+			site_options.spec_atom_1, site_options.spec_atom_2 = site[0], site[1]
+			if isinstance(site_options.spec_atom_2, (list, tuple)):
+				site_options.spec_atom_2 = [int(atom) for atom in site_options.spec_atom_2]
+			elif not isinstance(site_options.spec_atom_2, str):
+				site_options.spec_atom_2 = str(site_options.spec_atom_2)
+			dbstep._get_spec_atoms(self, site_options)
+			atom3 = int(site[2]) if len(site) == 3 and site[2] not in [False, None] else False
+			self.sites.append((site_options.spec_atom_1, site_options.spec_atom_2, atom3))
+
+		# parse once, the atoms of each site are removed (noH, exclude) from a copy of the parsed molecule
+		if isinstance(file, str):
+			name, ext = parse_data.split_ext(file)
+		elif isinstance(file, parse_data.DataParser):
+			name, ext = str(file), 'parsed'
+		else:
+			name, ext = 'molecule', 'rdkit'
+		if ext == '.cube':
+			# the density is parsed again for each frame
+			mol_input = file
+		else:
+			parse_options = copy.deepcopy(options)
+			parse_options.noH, parse_options.exclude = False, False
+			parse_options.spec_atom_1, parse_options.spec_atom_2 = 1, [2]
+			parsed = parse_data.read_input(file, ext, parse_options)
+
+		# sites measured in the same frame give the same results
+		frames = {}
+		rotated = options.sterimol and not options.norot
+		for n, (atom1, atom2, atom3) in enumerate(self.sites):
+			if rotated or options.noH or options.exclude:
+				frame = (atom1, tuple(atom2), atom3 if rotated else False)
+			else:
+				frame = (atom1,)
+			frames.setdefault(frame, []).append(n)
+
+		self.results = [None] * len(self.sites)
+		for frame, numbers in frames.items():
+			atom1, atom2, atom3 = self.sites[numbers[0]]
+			label = '{} site {}'.format(os.path.basename(name), ','.join(str(n + 1) for n in numbers))
+			if ext != '.cube':
+				mol_input = parse_data.ArrayParser(parsed.ATOMTYPES, parsed.CARTESIANS, label)
+			if not options.quiet:
+				atoms = "atom1: {} / atom2: {}".format(atom1, ','.join(str(atom) for atom in atom2))
+				if atom3: atoms += " / atom3: {}".format(atom3)
+				print("\n   {} / {}".format(label, atoms))
+			site_options = copy.deepcopy(options)
+			site_options.spec_atom_1, site_options.spec_atom_2, site_options.atom3 = atom1, atom2, atom3
+			result = dbstep(mol_input, options=site_options)
+			for n in numbers:
+				self.results[n] = result
+		self.options = options
+
+		params = []
+		if options.sterimol: params += ['L', 'Bmin', 'Bmax']
+		if options.measure == 'grid': params += ['occ_vol']
+		if options.volume: params += ['bur_vol', 'bur_shell']
+		self.L, self.Bmin, self.Bmax, self.occ_vol, self.bur_vol, self.bur_shell = False, False, False, False, False, False
+		for param in params:
+			setattr(self, param, np.array([getattr(result, param) for result in self.results], dtype=float))
+
+
 class options_add:
 	pass
 
@@ -427,7 +811,13 @@ def set_options(kwargs):
 	'gridsize': ['gridsize', False], 'measure':['measure','grid'],'pos':['pos',False],
 	'graph':['graph',False], 'fg':['shared_fg',False], 'shared_fg':['shared_fg',False],
 	'maxpath':['max_path_length', 9], 'max_path_length':['max_path_length',9],
-	'voltype':['voltype','crippen'], 'visv':['visv','circle'], 'viss':['viss',False]
+	'voltype':['voltype','crippen'], 'visv':['visv','circle'], 'viss':['viss',False],
+	'engine':['engine','kdtree'], 'hull':['hull',False], 'increments':['increments',361],
+	'boundary':['boundary',False], 'threads':['threads',0], 'jobs':['jobs',1],
+	'cache':['cache',False], 'cachesize':['cachesize',512], 'traj':['traj',False],
+	'steps':['steps',False], 'output':['output',False],
+	'sites':['sites',False], 'mmap':['mmap',False], 'isoscan':['isoscan',False],
+	'qsarformat':['qsar_format','xyz'], 'qsar_format':['qsar_format','xyz']
 	}
 
 	for key in var_dict:
@@ -441,6 +831,78 @@ def set_options(kwargs):
 	return options
 
 
+BatchResult = namedtuple('BatchResult', ['index', 'input', 'mol', 'error', 'output'])
+BatchResult.__doc__ = """Result of one input of a batch: its position in the input list, the input itself, 
+the dbstep object (None if it failed), the error message (None if it succeeded) and the printed output"""
+
+
+def worker_threads(n_jobs, threads=0):
+	"""Kernel threads of each of n_jobs workers: threads if nonzero, otherwise the cores shared between the workers"""
+	return threads if threads else max(1, (os.cpu_count() or 1) // n_jobs)
+
+
+def init_worker(threads, warmup=None):
+	"""Runs once in each worker: sets the kernel thread count, compiles (or loads) the kernels and calls warmup (if given)"""
+	kernels.set_threads(threads)
+	kernels.warmup()
+	if warmup is not None: warmup()
+
+
+def worker_pool(n_jobs, threads, warmup=None):
+	"""Pool of n_jobs worker processes, each started by init_worker with threads kernel threads and warmup, 
+	which must be picklable. The jobs should also set threads in their options, the default of 0 leaves it as it is"""
+	from concurrent.futures import ProcessPoolExecutor
+	import multiprocessing
+	# workers are spawned rather than forked, forking a process after numba has started its threads is not safe
+	return ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+		initializer=init_worker, initargs=(threads, warmup))
+
+
+def _batch_job(index, mol_input, options):
+	"""Computes one input of a batch. Anything that would stop the program (including sys.exit
+	from a bad input) is returned as an error so that it can't stop the rest of the batch"""
+	mol, error, output = None, None, io.StringIO()
+	try:
+		with contextlib.redirect_stdout(output):
+			mol = dbstep(mol_input, options=options)
+	except SystemExit as e:
+		# a bare exit() has no message, the last line printed before it says what went wrong
+		error = str(e) if e.code is not None else (output.getvalue().strip().splitlines() or ['exit()'])[-1].strip()
+	except Exception as e:
+		error = "{}: {}".format(type(e).__name__, e)
+	return BatchResult(index, mol_input, mol, error, output.getvalue())
+
+
+def batch(files_or_mols, n_jobs=1, ordered=True, options=None, **kwargs):
+	"""Computes steric parameters for many inputs (file names or RDKit mol objects), fanned out over
+	a pool of n_jobs worker processes (n_jobs=-1 uses every core). Options are given as keyword arguments, 
+	as for dbstep, or as an options object, and each input gets its own copy of them.
+
+	Yields a BatchResult for each input as it completes, in input order if ordered=True. 
+	An input that fails is yielded with its error rather than raising, so one bad file can't stop the batch.
+	"""
+	if options is None:
+		options = set_options(kwargs)
+	inputs = list(files_or_mols)
+	if n_jobs is None or n_jobs < 1:
+		n_jobs = os.cpu_count() or 1
+	n_jobs = min(n_jobs, max(len(inputs), 1))
+
+	if n_jobs == 1:
+		for index, mol_input in enumerate(inputs):
+			yield _batch_job(index, mol_input, copy.deepcopy(options))
+		return
+
+	from concurrent.futures import as_completed
+	# share the cores between the workers unless a thread count was asked for
+	options = copy.deepcopy(options)
+	options.threads = worker_threads(n_jobs, options.threads)
+	with worker_pool(n_jobs, options.threads) as executor:
+		futures = [executor.submit(_batch_job, index, mol_input, copy.deepcopy(options)) for index, mol_input in enumerate(inputs)]
+		for future in (futures if ordered else as_completed(futures)):
+			yield future.result()
+
+
 def main():
 	files=[]
 	# get command line inputs. Use -h to list all possible arguments and default values
@@ -457,15 +919,30 @@ def main():
 	parser.add_option("--noH", dest="noH", action="store_true", help="Neglect hydrogen atoms (by default these are included)", default=False, metavar="noH")
 	parser.add_option("--addmetals", dest="add_metals", action="store_true", help="By default, the VDW radii of metals are not considered. This will include them", default=False, metavar="add_metals")
 	parser.add_option("--norot",dest='norot',action="store_true",help="Do not rotate the molecules (use if structures have been pre-aligned)",default=False)
+	parser.add_option("--engine", dest="engine", action="store", choices=['kdtree','voxel'], help="Grid occupancy engine: KD-tree queries (kdtree=default) or a boolean voxel array (voxel, much lower memory)", default='kdtree', metavar="engine")
 	parser.add_option("--grid", dest="grid", action="store", help="Specify how grid point spacing used to compute spatial occupancy", default=0.05, type=float, metavar="grid")
 	parser.add_option("--2d", dest="graph",action="store_true", help="[2D sterics only] Specify input text file containing SMILES strings to analyze 2D contributions",default=False)
 	parser.add_option("--fg",  dest="shared_fg", action="store", default=False, help="[2D sterics only] SMILES pattern (e.g. 'C(O)=O') of a shared functional group or atom - this is used to define the origin")
 	parser.add_option("--maxpath", dest="max_path_length", type=int, action="store", default=9, help="[2D sterics only] Maximum path length (bonds) along which to include steric contributions (Default: 9)")
 	parser.add_option("--2d-type", dest="voltype", action="store", default="crippen",choices=['crippen','mcgowan','degree'], help="[2D sterics only] Method for determining atomic contribution to total volume. Options include 'crippen'=default,'mcgowan', or 'degree'")
+	parser.add_option("--hull", dest="hull", action="store_true", help="Compute Bmin and Bmax exactly from the convex hull of the projected molecule instead of an angular sweep", default=False)
+	parser.add_option("--boundary", dest="boundary", action="store_true", help="Measure grid Sterimol parameters from the boundary (surface) voxels only, which gives identical results faster", default=False)
+	parser.add_option("--increments", dest="increments", action="store", help="Number of directions swept around the L-axis to find Bmin (default = 361, i.e. 1 degree intervals)", default=361, type=int, metavar="increments")
+	parser.add_option("--cache", dest="cache", action="store", help="SQLite file in which to cache results, repeated runs with the same geometry and settings are read from it", default=False, metavar="cache")
+	parser.add_option("--cachesize", dest="cachesize", action="store", help="Size limit of the result cache in MB (default = 512), the least recently used results are removed", default=512, type=float, metavar="cachesize")
+	parser.add_option("--traj", dest="traj", action="store_true", help="Treat each input as a multi-frame xyz trajectory, frames are read and measured one at a time", default=False)
+	parser.add_option("--steps", dest="steps", action="store", help="Measure several geometries of an optimization or scan output file from a single parse: all, indices such as 0,-1 or a range start:stop[:step]", default=False, metavar="steps")
+	parser.add_option("--sites", dest="sites", action="store", help="Measure several sites of each molecule from one parse, as atom1:atom2[:atom3] separated by ';' (ex: '1:2;5:6,7')", default=False, metavar="sites")
+	parser.add_option("--output", dest="output", action="store", help="File to write a table of results to, one row per molecule (per radius for a scan): .csv, .jsonl or .parquet", default=False, metavar="output")
+	parser.add_option("--jobs", dest="jobs", action="store", help="Number of input files processed in parallel worker processes (default = 1, -1 uses every core)", default=1, type=int, metavar="jobs")
+	parser.add_option("--threads", dest="threads", action="store", help="Number of threads used by the parallel grid kernels (default = all available cores)", default=0, type=int, metavar="threads")
 	parser.add_option("--pos", dest="pos", action="store_true", help="Measure Sterimol parameters in postive direction (from atom1 toward atom2). ", default=False, metavar="pos")
+	parser.add_option("--mmap", dest="mmap", action="store_true", help="Store the density of each cube file in a binary .npy file next to it, which later runs memory-map instead of reading the cube again", default=False)
 	parser.add_option("--isoval", dest="isoval", action="store", help="Density isovalue cutoff (default = 0.002)", type="float", default=0.002, metavar="isoval")
+	parser.add_option("--isoscan", dest="isoscan", action="store", help="Scan over a range of density isovalues 'min:max:interval' from a single parse of each cube", default=False, metavar="isoscan")
 	parser.add_option("--vshell",dest="vshell",action="store",help="Calculate buried volume of hollow sphere. Input: shell width, use '-r' option to adjust radius'", default=False,type=float, metavar="radius")
-	parser.add_option("--qsar", dest="qsar", action="store_true", help="Construct a grid with probe atom at each point for QSAR study (this generates a lot of files!)", default=False, metavar="qsar")
+	parser.add_option("--qsar", dest="qsar", action="store_true", help="Construct a grid with probe atom at each point for QSAR study (this generates a lot of files, unless --qsarformat npz is used!)", default=False, metavar="qsar")
+	parser.add_option("--qsarformat", dest="qsar_format", action="store", choices=['xyz','npz'], help="QSAR output: an xyz file for each grid point (xyz=default) or the molecule and every probe position in a single .npz file (npz)", default='xyz', metavar="qsar_format")
 	parser.add_option("--gridsize", dest="gridsize", action="store",help="Set size of grid to analyze molecule centered at origin 'xmin,xmax:ymin,ymax:zmin,zmax'",default=False)
 	parser.add_option("--scalevdw", dest="SCALE_VDW", action="store", help="Scaling factor for VDW radii (default = 1.0)", type=float, default=1.0, metavar="SCALE_VDW")
 	parser.add_option("-t", "--timing",dest="timing",action="store_true", help="Request timing information", default=False)
@@ -481,9 +958,9 @@ def main():
 	# make sure upper/lower case doesn't matter
 	options.surface = options.surface.lower()
 
-	# Get input files from commandline
-	if len(sys.argv) > 1:
-		for elem in sys.argv[1:]:
+	# Get input files from commandline (option values such as a --cache file are not inputs)
+	if len(args) > 0:
+		for elem in args:
 			try:
 				for file in glob(elem):
 					files.append(file)
@@ -515,8 +992,69 @@ def main():
 		options.gridsize = str(dim[0])+','+str(dim[1])+':'+str(dim[2])+','+str(dim[3])+':'+str(dim[4])+','+str(dim[5])
 		if options.verbose: print("   Grid size for QSAR mode is: "+options.gridsize)
 	
+	# results are also written as a table if requested
+	sink = writer.ResultSink(options.output) if options.output and not options.graph else None
+	try:
+		run(files, options, sink)
+	finally:
+		if sink is not None: sink.close()
+
+
+def run(files, options, sink=None):
+	"""Measures each of the input files as requested by the command line options, 
+	adding the results to sink (a writer.ResultSink) if given"""
+	if options.jobs != 1 and (options.sites or options.steps or options.traj):
+		print("   Warning! --jobs has no effect with --sites, --steps or --traj, the files are measured one at a time")
+	# measure every site of each molecule
+	if options.sites:
+		for file in files:
+			sites = multisite(file, options.sites, options=options)
+			if sink is not None:
+				for n, (site, mol) in enumerate(zip(sites.sites, sites.results)): sink.add(mol, '{} site {}'.format(file, n + 1))
+		return
+
+	# measure the selected geometries of each output file as an ensemble
+	if options.steps:
+		for file in files:
+			steps = ensemble(file, options=options)
+			if sink is not None:
+				for label, mol in zip(steps.labels, steps.conformers): sink.add(mol, label)
+		return
+
+	# stream the frames of each trajectory, printing the results of each frame as it completes
+	if options.traj:
+		for file in files:
+			if not options.quiet: print("\n   Trajectory {}".format(file))
+			for mol in trajectory(file, options=options): 
+				if sink is not None: sink.add(mol)
+		return
+
+	# in qsar mode the occupied grid points of each molecule are kept for a one-hot matrix over the shared grid
+	onehot = []
+	def add_onehot(file, mol):
+		if options.qsar and mol.onehot_grid is not False:
+			onehot.append((file, np.flatnonzero(mol.onehot_grid), len(mol.onehot_grid)))
+
+	# spread the input files over worker processes, output is printed in input order as each file completes
+	if options.jobs != 1 and not options.graph:
+		for result in batch(files, n_jobs=options.jobs, options=options):
+			print(result.output, end='')
+			if result.error is not None:
+				print("   ERROR in {}: {}".format(result.input, result.error))
+				continue
+			if sink is not None: sink.add(result.mol, result.input)
+			add_onehot(result.input, result.mol)
+		_write_onehot(onehot, options)
+		return
+
 	# loop over all specified output files
 	for file in files:
+		if options.isoscan and not options.graph:
+			mol = dbstep(file,options=options)
+			if sink is not None:
+				for isoval, occ_vol, (rad, bur_vol, bur_shell, Bmin, Bmax, L) in zip(mol.isovals, mol.occ_vol, mol.rows):
+					sink.write(['{} isoval {:g}'.format(file, isoval), rad, L, Bmin, Bmax, occ_vol, bur_vol, bur_shell])
+			continue
 		if options.graph: 
 			try:
 				from dbstep import graph
@@ -526,7 +1064,23 @@ def main():
 			vec_df = graph.mol_to_vec(file,options.shared_fg,options.voltype,options.max_path_length,options.verbose)
 			vec_df.to_csv(file.split('.')[0]+"_2d_output.csv",index=False)
 		else:
-			dbstep(file,options=options)
+			mol = dbstep(file,options=options)
+			if sink is not None: sink.add(mol, file)
+			add_onehot(file, mol)
+	_write_onehot(onehot, options)
+
+
+def _write_onehot(onehot, options):
+	"""Writes the one-hot occupancy of each molecule of a qsar run (a list of file, occupied grid point indices 
+	and number of grid points) as the rows of a sparse matrix in qsar_onehot.npz, with the files in qsar_onehot.txt"""
+	if len(onehot) == 0: return
+	if len(set(n_points for file, occupied, n_points in onehot)) > 1:
+		print("   The molecules have different QSAR grids, no one-hot matrix is written (set a common grid with --gridsize)"); return
+	writer.onehot_export('qsar_onehot.npz', [occupied for file, occupied, n_points in onehot], onehot[0][2])
+	with open('qsar_onehot.txt', 'w') as f:
+		f.write(''.join(str(file) + '\n' for file, occupied, n_points in onehot))
+	if not options.quiet:
+		print("\n   One-hot occupancy of {} molecules over {} grid points written to qsar_onehot.npz (rows in the order of qsar_onehot.txt)".format(len(onehot), onehot[0][2]))
 
 if __name__ == "__main__":
 	main()
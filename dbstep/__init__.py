@@ -1,6 +1,8 @@
 from dbstep import Dbstep
+from dbstep.Dbstep import batch, ensemble, multisite, trajectory
 from dbstep import calculator
 from dbstep import sterics
 from dbstep import parse_data
 from dbstep import writer
+from dbstep.writer import ResultSink
 from dbstep import constants
\ No newline at end of file
@@ -14,4 +14,8 @@ if __package__ == '':
 from dbstep import Dbstep
 
 if __name__ == '__main__':
+    # python -m dbstep serve starts the long-running server mode
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from dbstep import server
+        sys.exit(server.main(sys.argv[2:]))
     sys.exit(Dbstep.main())
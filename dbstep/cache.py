@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+import hashlib, json, sqlite3, time
+from contextlib import closing
+import numpy as np
+
+
+"""
+cache
+
+Stores steric results in a local SQLite database keyed by a hash of everything that determines them:
+the prepared atoms, coordinates and radii (or density) and every option that affects the numbers.
+Repeated runs on the same geometry with the same settings then skip the grid and measurements entirely.
+The least recently used results are evicted when the database grows past its size limit.
+"""
+
+
+# bump when a change to the code changes the numbers, so that older results are no longer used
+CACHE_VERSION = 2
+
+# options that only affect what is printed or written, or how the work is done, not the results
+OUTPUT_OPTIONS = {'verbose', 'quiet', 'commandline', 'timing', 'debug', 'visv', 'viss', 'threads', 'jobs', 'cache', 'cachesize', 'traj', 'steps', 'output', 'sites', 'mmap', 'qsar_format'}
+
+
+def result_key(mol, options):
+	"""sha256 hex digest of a prepared molecule (after translation, rotation and removal of metals) and the
+	options that affect its steric parameters"""
+	settings = {key: value for key, value in vars(options).items() if key not in OUTPUT_OPTIONS}
+	digest = hashlib.sha256()
+	digest.update(json.dumps([CACHE_VERSION, settings], sort_keys=True, default=str).encode())
+	digest.update(json.dumps([str(atom) for atom in mol.ATOMTYPES]).encode())
+	digest.update(np.ascontiguousarray(mol.CARTESIANS, dtype=np.float64).tobytes())
+	if options.surface == 'density':
+		digest.update(json.dumps([mol.xdim, mol.ydim, mol.zdim, float(mol.SPACING)]).encode())
+		digest.update(np.ascontiguousarray(mol.ORIGIN, dtype=np.float64).tobytes())
+		digest.update(np.ascontiguousarray(mol.DENSITY, dtype=np.float64).tobytes())
+	else:
+		digest.update(np.ascontiguousarray(mol.RADII, dtype=np.float64).tobytes())
+	return digest.hexdigest()
+
+
+class ResultCache:
+	"""Results stored as JSON in a SQLite database at path, limited to max_size MB. Several processes can
+	share the same database (e.g. the workers of a batch)."""
+	def __init__(self, path, max_size=512):
+		self.path = path
+		self.max_bytes = int(float(max_size) * 1024 ** 2)
+		with closing(self._connect()) as db, db:
+			db.execute("CREATE TABLE IF NOT EXISTS results "
+				"(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+
+	def _connect(self):
+		return sqlite3.connect(self.path, timeout=60)
+
+	def key(self, mol, options):
+		return result_key(mol, options)
+
+	def get(self, key):
+		"""The results stored under key, or None. A hit marks the results as recently used"""
+		with closing(self._connect()) as db, db:
+			row = db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				return None
+			db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+		return json.loads(row[0])
+
+	def put(self, key, results):
+		"""Stores results (a dictionary of numbers, lists and strings) under key, then evicts the least
+		recently used results until the database is within its size limit"""
+		value = json.dumps(results, default=float)
+		with closing(self._connect()) as db, db:
+			db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+			total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+			if total > self.max_bytes:
+				for old_key, size in db.execute("SELECT key, size FROM results ORDER BY used").fetchall():
+					if total <= self.max_bytes:
+						break
+					db.execute("DELETE FROM results WHERE key = ?", (old_key,))
+					total -= size
+
+	def __len__(self):
+		with closing(self._connect()) as db:
+			return db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -1,7 +1,6 @@
 # -*- coding: UTF-8 -*-
 import math
 import numpy as np
-from scipy.spatial.transform import Rotation as R
 import sys
 from dbstep.constants import metals
 
@@ -90,6 +89,58 @@ def rotate_mol(
 		return new_coords, new_cube_origin
 
 
+def align_ensemble(coords, spec_atom_1, spec_atom_2, atom3=False, rotate=True):
+	"""Translates and rotates every conformer of an ensemble at once, as translate_mol and rotate_mol
+	would do one conformer at a time: atom1 is placed at the origin and the atom1-atom2 vector along the
+	(positive) z-axis, with atom3 (if given) in the positive x direction.
+
+	Args:
+		coords (np.ndarray): (n_conf, n_atoms, 3) coordinates of each conformer
+		spec_atom_1 (int): non-zero based index of the atom we're looking down
+		spec_atom_2 (list of int): non-zero based indices of the atom(s) we're looking to
+		atom3 (int, optional): atom to align to the positive x direction & y=0
+		rotate (bool, optional): False only translates the conformers
+
+	Returns:
+		(n_conf, n_atoms, 3) aligned coordinates
+	"""
+	coords = np.array(coords, dtype=float)
+	coords = coords - coords[:, spec_atom_1 - 1, None, :]
+	if not rotate or coords.shape[1] < 2:
+		return coords
+	from scipy.spatial.transform import Rotation as R
+	n_conf = len(coords)
+	end_point = np.zeros((n_conf, 3))
+	for atom in spec_atom_2:
+		end_point += coords[:, atom - 1]
+
+	# the same angles, in the same order, as angle_between_axis and apply_rotation in rotate_mol
+	unit = end_point / np.linalg.norm(end_point, axis=1)[:, None]
+	yaw = np.arctan2(unit[:,1], unit[:,2])
+	rotated = np.round(R.from_euler('xyz', np.column_stack((yaw, np.zeros(n_conf), np.zeros(n_conf)))).apply(end_point), 8)
+	end_point = np.where((yaw != 0)[:, None], rotated, end_point)
+	unit = end_point / np.linalg.norm(end_point, axis=1)[:, None]
+	pitch = -np.arctan2(unit[:,0], unit[:,2])
+	roll = np.zeros(n_conf)
+	if atom3 is not False:
+		rotated = np.round(R.from_euler('xyz', np.column_stack((np.zeros(n_conf), pitch, np.zeros(n_conf)))).apply(end_point), 8)
+		end_point = np.where((pitch != 0)[:, None], rotated, end_point)
+		atom3_coords = coords[:, int(atom3) - 1]
+		vector = atom3_coords - end_point
+		unit = vector / np.linalg.norm(vector, axis=1)[:, None]
+		roll = -np.arctan2(unit[:,1], unit[:,0])
+		# if atom3 would point along negative x, turn it round by the smaller of +/- pi
+		check = np.round(R.from_euler('xyz', np.column_stack((np.zeros(n_conf), np.zeros(n_conf), roll))).apply(atom3_coords), 8)
+		flip = (roll != 0) & (check[:,0] < 0)
+		plus_pi, minus_pi = roll + np.pi, roll - np.pi
+		roll = np.where(flip, np.where(np.abs(plus_pi) < np.abs(minus_pi), plus_pi, minus_pi), roll)
+
+	angles = np.column_stack((yaw, pitch, roll))
+	matrices = R.from_euler('xyz', angles).as_matrix()
+	rotated = np.round(np.einsum('cij,caj->cai', matrices, coords), 8)
+	return np.where(np.any(angles != 0, axis=1)[:, None, None], rotated, coords)
+
+
 def angle_between_axis(vector, axis_from_index, axis_to_index):
 	""" Returns the angle in radians needed to rotate axis_from to be parallel to axis_to. """
 	v1_u = unit_vector(np.array(vector))
@@ -115,6 +166,7 @@ def print_rotation_info(axis, radians, verbose):
 
 def apply_rotation(item_to_rotate, radians):
 	"""Rotates a vector or matrix about x, y and z axes specified by radians array."""
+	from scipy.spatial.transform import Rotation as R
 	rot = R.from_euler('xyz', radians)
 	return np.round(rot.apply(item_to_rotate), 8)
 
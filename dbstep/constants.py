@@ -36,3 +36,4 @@ isovals = {"Bq": 0.00, "H": .00475}
 # Values
 
 BOHR_TO_ANG = 0.529177249
+GAS_CONSTANT = 0.0019872041 # kcal/(mol K), for Boltzmann weights of conformer energies in kcal/mol
@@ -1,8 +1,6 @@
 from rdkit import Chem
 from rdkit.Chem import rdmolops, rdMolDescriptors, Crippen, GraphDescriptors
 import numpy as np
-import pandas as pd
-import pkg_resources
 import sys
 
 def crippenHContribs(mol,contribs):
@@ -27,6 +25,8 @@ def degreeContribs(mol):
     return contribs
     
 def load_mcgowan():
+    import pandas as pd
+    import pkg_resources
     stream = pkg_resources.resource_stream(__name__, 'mcgowan.csv')
     return pd.read_csv(stream)
 
@@ -93,6 +93,7 @@ def mol_to_vec(input, shared_fg, voltype, max_path_length, verbose=False):
         Pandas DataFrame containing sum of atomic contributions for each layer requested in format:
             ["layer0",..."layerN","Structure" (SMILES string),"Property" (optional)]
 	"""
+    import pandas as pd
     # computes the atomic contributions to volume/sterics at discrete number of bond lengths away from a particular atom/functional group
     mollist, y_val, vec_df, columns = [], [], [], []
     [columns.append(str(col)+'_'+voltype.lower()) for col in range(0,max_path_length)]
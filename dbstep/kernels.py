@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+import math
+from importlib.util import find_spec
+import numpy as np
+
+
+"""
+kernels
+
+Hot loops of the steric calculations: the angular sweep for grid Bmin, squared distances and counts of
+points around the origin and the extraction of strips along the L-axis. When numba is installed these run
+as parallel compiled kernels from numba_kernels, which (like numba itself) is only imported the first time
+a kernel is called. If numba cannot be imported the same functions are provided by NumPy.
+"""
+
+
+HAVE_NUMBA = find_spec('numba') is not None
+_backend = None
+
+
+def _numpy_angular_sweep(points, angles):
+	"""Farthest projection (never less than zero) of points along each of the angles in the XY-plane"""
+	rmax = np.zeros(len(angles))
+	# directions are taken in blocks to bound the size of the projection array
+	block = max(1, 2 ** 22 // max(len(points), 1))
+	for n in range(0, len(angles), block):
+		cos, sin = np.cos(angles[n:n+block]), np.sin(angles[n:n+block])
+		if len(points) > 0:
+			r = points[:,0:1] * cos + points[:,1:2] * sin
+			rmax[n:n+block] = np.maximum(np.max(r, axis=0), 0.0)
+	return rmax
+
+
+def _numpy_sq_distances(points, center):
+	"""Squared distances of points from center, summed in x, y, z order as in a KD-tree ball query"""
+	d = (points - center) ** 2
+	return d[:,0] + d[:,1] + d[:,2]
+
+
+def _numpy_count_within(points, center, r2):
+	"""Number of points with a squared distance from center of at most r2"""
+	return int(np.count_nonzero(_numpy_sq_distances(points, center) <= r2))
+
+
+def _numpy_strip(points, lo, hi):
+	"""Points with lo < z <= hi"""
+	return points[(points[:,2] <= hi) & (points[:,2] > lo)]
+
+
+class _numpy_kernels:
+	"""Stands in for numba_kernels when numba is not available"""
+	angular_sweep = staticmethod(_numpy_angular_sweep)
+	sq_distances = staticmethod(_numpy_sq_distances)
+	count_within = staticmethod(_numpy_count_within)
+	strip = staticmethod(_numpy_strip)
+
+	@staticmethod
+	def set_threads(threads):
+		pass
+
+	@staticmethod
+	def get_threads():
+		return 1
+
+
+def backend():
+	"""The module (or class) providing the kernels, numba_kernels is imported on the first call"""
+	global _backend
+	if _backend is None:
+		_backend = _numpy_kernels
+		if HAVE_NUMBA:
+			try:
+				from dbstep import numba_kernels
+				_backend = numba_kernels
+			except ImportError:
+				pass
+	return _backend
+
+
+def angular_sweep(points, angles):
+	"""Farthest projection (never less than zero) of points along each of the angles in the XY-plane"""
+	return backend().angular_sweep(points, angles)
+
+
+def sq_distances(points, center):
+	"""Squared distances of points from center, summed in x, y, z order as in a KD-tree ball query"""
+	return backend().sq_distances(points, center)
+
+
+def count_within(points, center, r2):
+	"""Number of points with a squared distance from center of at most r2"""
+	return int(backend().count_within(points, center, r2))
+
+
+def strip(points, lo, hi):
+	"""Points with lo < z <= hi"""
+	return backend().strip(points, lo, hi)
+
+
+def as_points(points):
+	"""Float64 C-contiguous (n, 3) array, so that each kernel is compiled (and cached) only once"""
+	return np.ascontiguousarray(points, dtype=np.float64)
+
+
+def set_threads(threads):
+	"""Number of threads used by the parallel kernels, 0 or None restores numba's default (the thread count
+	it started with). Until a kernel has been loaded only a nonzero count loads them, so that a run with 
+	the default doesn't import numba early"""
+	if threads:
+		backend().set_threads(threads)
+	elif _backend is not None:
+		_backend.set_threads(None)
+
+
+def get_threads():
+	"""Number of threads currently used by the parallel kernels"""
+	return backend().get_threads()
+
+
+def warmup():
+	"""Compiles (or loads from the on-disk cache) every kernel, e.g. before timing or when a worker starts"""
+	points = as_points(np.zeros((2, 3)))
+	center = np.zeros(3)
+	angular_sweep(points, np.linspace(-math.pi, math.pi, 3))
+	sq_distances(points, center)
+	count_within(points, center, 1.0)
+	strip(points, -1.0, 1.0)
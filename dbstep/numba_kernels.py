@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+import math
+import numpy as np
+import numba
+from numba import njit, prange
+
+
+"""
+numba_kernels
+
+numba compiled versions of the functions in kernels. They run in parallel and are cached on disk so that a
+new process does not have to recompile them. This module is only imported (and numba only loaded) the first
+time a kernel is used, use the functions in kernels rather than calling these directly.
+"""
+
+
+# fastmath is limited to flags that cannot change a result (no contraction or reassociation of sums),
+# so the compiled sweep gives exactly the same numbers as the plain loop
+@njit(parallel=True, cache=True, fastmath={'nnan', 'ninf', 'nsz'})
+def angular_sweep(points, angles):
+	"""Farthest projection (never less than zero) of points along each of the angles in the XY-plane"""
+	rmax = np.zeros(len(angles))
+	for n in prange(len(angles)):
+		cos, sin = math.cos(angles[n]), math.sin(angles[n])
+		r_n = 0.0
+		for i in range(len(points)):
+			r = points[i,0] * cos + points[i,1] * sin
+			if r > r_n:
+				r_n = r
+		rmax[n] = r_n
+	return rmax
+
+
+# distances are compared with a radius, so these are compiled without fastmath
+@njit(parallel=True, cache=True)
+def sq_distances(points, center):
+	"""Squared distances of points from center, summed in x, y, z order as in a KD-tree ball query"""
+	d = np.empty(len(points))
+	for i in prange(len(points)):
+		d[i] = (points[i,0] - center[0]) ** 2 + (points[i,1] - center[1]) ** 2 + (points[i,2] - center[2]) ** 2
+	return d
+
+
+@njit(parallel=True, cache=True)
+def count_within(points, center, r2):
+	"""Number of points with a squared distance from center of at most r2"""
+	n = 0
+	for i in prange(len(points)):
+		if (points[i,0] - center[0]) ** 2 + (points[i,1] - center[1]) ** 2 + (points[i,2] - center[2]) ** 2 <= r2:
+			n += 1
+	return n
+
+
+@njit(parallel=True, cache=True)
+def strip(points, lo, hi):
+	"""Points with lo < z <= hi"""
+	inside = np.empty(len(points), dtype=np.bool_)
+	for i in prange(len(points)):
+		inside[i] = points[i,2] <= hi and points[i,2] > lo
+	return points[inside]
+
+
+# numba's thread count when this module is imported, restored by set_threads(0)
+DEFAULT_THREADS = numba.get_num_threads()
+
+
+def set_threads(threads):
+	"""Number of threads used by the parallel kernels, capped at the number numba was started with.
+	0 or None restores numba's default"""
+	if not threads:
+		threads = DEFAULT_THREADS
+	numba.set_num_threads(max(1, min(int(threads), numba.config.NUMBA_NUM_THREADS)))
+
+
+def get_threads():
+	"""Number of threads currently used by the parallel kernels"""
+	return numba.get_num_threads()
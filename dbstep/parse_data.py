@@ -1,7 +1,6 @@
 # -*- coding: UTF-8 -*-
-import os, sys
+import os, sys, copy, importlib, struct, zipfile
 import numpy as np
-import cclib
 from abc import ABC, abstractmethod
 from dbstep.constants import BOHR_TO_ANG, periodic_table
 
@@ -13,9 +12,36 @@ Parses data from files
 Currently supporting: 
 	.cube Gaussian volumetric files 
 	all filetypes parsed by the cclib python package (see https://cclib.github.io/)
+Cube and xyz files can also be gzip, bzip2 or xz compressed (e.g. .cube.gz), they are decompressed as they are read
 """
 
 
+# compression suffixes and the module (imported when needed) that decompresses them
+COMPRESSION = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+
+# approximate number of characters of cube text parsed at a time
+DENSITY_BLOCK = 1 << 22
+
+
+def split_ext(file):
+	"""Splits a path into its name and extension like os.path.splitext, looking through a compression suffix
+	(e.g. 'Et.cube.gz' gives 'Et' and '.cube')"""
+	name, ext = os.path.splitext(file)
+	if ext.lower() in COMPRESSION:
+		name, ext = os.path.splitext(name)
+	return name, ext
+
+
+def open_input(file, binary=False):
+	"""Opens a file for reading as text (or bytes if binary). A gzip, bzip2 or xz compressed file (by its suffix) 
+	is decompressed as a stream while it is read, it is never decompressed to disk or held in memory as a whole"""
+	mode = 'rb' if binary else 'rt'
+	compression = COMPRESSION.get(os.path.splitext(file)[1].lower())
+	if compression is None:
+		return open(file, mode)
+	return importlib.import_module(compression).open(file, mode)
+
+
 def read_input(molecule, ext, options):
 	"""Chooses a Parser based on input molecule format.
 
@@ -29,12 +55,19 @@ def read_input(molecule, ext, options):
 	"""
 	if ext == '.cube':
 		options.surface = 'density'
-		mol = CubeParser(molecule, "cube")
+		mol = CubeParser(molecule, "cube", mmap=options.mmap)
 	else:
 		if ext in [".xyz", '.com', '.gjf']:
 			mol = XYZParser(molecule, ext[1:], options.noH, options.exclude, options.spec_atom_1, options.spec_atom_2)
 		elif ext == 'rdkit':
 			mol = RDKitParser(molecule, options.noH, options.exclude, options.spec_atom_1, options.spec_atom_2)
+		elif ext == 'parsed':
+			# already parsed (e.g. an ArrayParser), copied as the calculation modifies it
+			mol = copy.deepcopy(molecule)
+			if options.noH or options.exclude:
+				mol.noH, mol.exclude = options.noH, options.exclude
+				mol.spec_atom_1, mol.spec_atom_2 = options.spec_atom_1, options.spec_atom_2
+				mol.exclude_atoms()
 		else:
 			mol = cclibParser(molecule, ext[1:], options.noH, options.exclude, options.spec_atom_1, options.spec_atom_2)
 		if options.noH or options.exclude:
@@ -43,6 +76,97 @@ def read_input(molecule, ext, options):
 	return mol
 
 
+def iter_xyz_frames(file):
+	"""Reads a multi-frame xyz file (e.g. an MD or IRC trajectory or a CREST conformer ensemble) one frame at a time.
+	Each frame is a line with the number of atoms, a comment line and a line for each atom (symbol x y z).
+
+	Args:
+		file (str): path to the xyz file, which can be compressed (see open_input)
+
+	Yields:
+		comment line, list of atom symbols and (n_atoms, 3) numpy array of Cartesians for each frame
+	"""
+	with open_input(file) as f:
+		frame = 0
+		for line in f:
+			if len(line.split()) == 0: continue
+			frame += 1
+			try:
+				n_atoms = int(line.split()[0])
+			except ValueError:
+				sys.exit(f'  Unable to parse \"{file}\", frame {frame} does not start with the number of atoms.')
+			comment = next(f, '').strip()
+			atoms, coords = [], np.empty((n_atoms, 3))
+			for n in range(n_atoms):
+				fields = next(f, '').split()
+				try:
+					coords[n] = [float(value) for value in fields[1:4]]
+					atoms.append(fields[0])
+				except (ValueError, IndexError):
+					sys.exit(f'  Unable to parse \"{file}\", atom {n + 1} of frame {frame} could not be read in.')
+			yield comment, atoms, coords
+
+
+def select_steps(n_steps, steps):
+	"""Indices (from 0) of the geometries of an output file selected by steps: 'all', a comma separated 
+	list of indices (negative indices count back from the last geometry, e.g. '0,-1') or a range 'start:stop[:step]'
+
+	Args:
+		n_steps (int): number of geometries in the file
+		steps (str, int or list of int): the geometries to select
+
+	Returns:
+		list of int
+	"""
+	try:
+		if steps is True or steps == 'all':
+			indices = range(n_steps)
+		elif isinstance(steps, str) and ':' in steps:
+			indices = range(n_steps)[slice(*[int(value) if value.strip() else None for value in steps.split(':')])]
+		else:
+			if isinstance(steps, str): steps = steps.split(',')
+			elif isinstance(steps, (int, np.integer)): steps = [steps]
+			indices = [range(n_steps)[int(step)] for step in steps]
+	except (ValueError, IndexError, TypeError):
+		sys.exit(f'  Unable to select geometries \"{steps}\" of the {n_steps} in the file, try all, 0,-1 or 0:10:2.')
+	if len(indices) == 0:
+		sys.exit(f'  No geometries selected by \"{steps}\" of the {n_steps} in the file.')
+	return list(indices)
+
+
+def read_qsar_grid(path):
+	"""Reads a QSAR grid container written by writer.qsar_export. Its members are stored uncompressed, so the
+	probe positions are returned as a read-only memory map of the file and a slice of them (e.g. the share 
+	of one energy job) only reads those positions from disk.
+
+	Args:
+		path (str): path to the .npz container
+
+	Returns:
+		dictionary of atoms, coords, probe, points (memory-mapped) and reference
+	"""
+	grid = {}
+	with zipfile.ZipFile(path) as container, open(path, 'rb') as f:
+		for info in container.infolist():
+			key = info.filename[:-len('.npy')]
+			if key == 'points' and info.compress_type == zipfile.ZIP_STORED:
+				# the .npy data of a member follows its local file header: 30 bytes, the file name and an extra field
+				f.seek(info.header_offset + 26)
+				name_length, extra_length = struct.unpack('<HH', f.read(4))
+				f.seek(info.header_offset + 30 + name_length + extra_length)
+				version = np.lib.format.read_magic(f)
+				if version == (1, 0):
+					shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+				else:
+					shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+				grid[key] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+			else:
+				with container.open(info) as member:
+					grid[key] = np.lib.format.read_array(member)
+	if 'probe' in grid: grid['probe'] = str(grid['probe'])
+	return grid
+
+
 class DataParser(ABC):
 	"""Abstract base class made to be inherited by parsers for different molecule formats.
 
@@ -122,7 +246,8 @@ class DataParser(ABC):
 		self.spec_atom_1 = spec_atoms[0] + 1
 		self.spec_atom_2 = [atom+1 for atom in spec_atoms[1:]]
 		self.ATOMTYPES = self.ATOMTYPES[np.invert(atoms_to_remove)]
-		self.CARTESIANS = self.CARTESIANS[np.invert(atoms_to_remove)]
+		# the last but one axis is the atoms, so this also works for an (n_conf, n_atoms, 3) ensemble
+		self.CARTESIANS = self.CARTESIANS[..., np.invert(atoms_to_remove), :]
 
 
 	@staticmethod
@@ -130,22 +255,28 @@ class DataParser(ABC):
 		""""Reads file and returns the lines using readlines()
 
 		Args:
-		file (str): the path to the file
+		file (str): the path to the file, which can be compressed (see open_input)
 
 		Returns:
 			list with lines of the file
 		"""
-		with open(file, 'r') as f:
+		with open_input(file) as f:
 			return f.readlines()
 
 
 class CubeParser(DataParser):
-	"""Read data from cube file, obtian XYZ Cartesians, dimensions, and volumetric data."""
+	"""Read data from cube file, obtian XYZ Cartesians, dimensions, and volumetric data.
 
-	def __init__(self, file, input_format):
-		super().__init__(file, input_format, manual_file_lines=True)
+	The header is read line by line and the volumetric data in blocks of lines into a flat numpy array (DENSITY) 
+	of dtype, so a compressed cube is decompressed as a stream and only the array and one block of text are in memory.
+	With mmap the density is also stored in a binary sidecar (file.npy) that later runs memory-map instead 
+	of parsing the text again, the sidecar is rewritten whenever the cube file is newer.
+	"""
+
+	def __init__(self, file, input_format, mmap=False, dtype=np.float64):
+		self.mmap, self.dtype = mmap, np.dtype(dtype)
+		super().__init__(file, input_format)
 		self.INCREMENTS = np.asarray([self.x_inc, self.y_inc, self.z_inc])
-		self.DENSITY = np.asarray(self.DENSITY)
 		self.DATA = np.reshape(self.DENSITY, (self.xdim, self.ydim, self.zdim))
 
 	def parse_input(self):
@@ -155,36 +286,74 @@ class CubeParser(DataParser):
 
 		"""
 		self.num_atoms = None
-		self.ATOMNUM, self.DENSITY, self.DENSITY_LINE = [], [], []
-		file_lines = self.file_lines
+		self.ATOMNUM = []
 		start_of_atoms = 6
 
-		# first two lines skipped as they do not have useful information for this program
-		for i in range(2, len(file_lines)):
+		with open_input(self._input) as f:
+			# first two lines skipped as they do not have useful information for this program
+			i = 0
 			try:
-				curr_line = file_lines[i]
-				coord = [float(c) for c in curr_line.split()]
-				if i == 2:
-					self.num_atoms = coord[0]
-					self.ORIGIN = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
-				elif i == 3:
-					self.xdim = int(coord[0])
-					self.SPACING = coord[1]*BOHR_TO_ANG
-					self.x_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
-				elif i == 4:
-					self.ydim = int(coord[0])
-					self.y_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
-				elif i == 5:
-					self.zdim = int(coord[0])
-					self.z_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG,coord[3]*BOHR_TO_ANG]
-				elif self.num_atoms and start_of_atoms <= i < start_of_atoms + self.num_atoms:
-					self._parse_atom_line(coord)
-				else:
-					self._parse_density_line(coord, curr_line)
-			except ValueError as e:
+				for i in range(2):
+					next(f)
+				for i in range(2, start_of_atoms):
+					coord = [float(c) for c in next(f).split()]
+					if i == 2:
+						self.num_atoms = int(coord[0])
+						self.ORIGIN = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
+					elif i == 3:
+						self.xdim = int(coord[0])
+						self.SPACING = coord[1]*BOHR_TO_ANG
+						self.x_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
+					elif i == 4:
+						self.ydim = int(coord[0])
+						self.y_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG, coord[3]*BOHR_TO_ANG]
+					elif i == 5:
+						self.zdim = int(coord[0])
+						self.z_inc = [coord[1]*BOHR_TO_ANG, coord[2]*BOHR_TO_ANG,coord[3]*BOHR_TO_ANG]
+				for i in range(start_of_atoms, start_of_atoms + self.num_atoms):
+					self._parse_atom_line([float(c) for c in next(f).split()])
+			except (ValueError, IndexError, StopIteration):
 				# TODO: make a custom cube file exception to chain ValueError with this error
 				# TODO: handle potentially invalid atom errors
 				sys.exit(f'  Unable to parse \"{self._input}\", a value on line {i + 1} could not be read in.')
+			# number of lines before the volumetric data
+			self.HEADER_LINES = start_of_atoms + self.num_atoms
+
+			n_values = self.xdim * self.ydim * self.zdim
+			sidecar = self._input + '.npy'
+			if self.mmap and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(self._input):
+				density = np.load(sidecar, mmap_mode='r')
+				if density.shape == (n_values,) and density.dtype == self.dtype:
+					self.DENSITY = density
+					return
+			self.DENSITY = self._read_density(f, n_values)
+		if len(self.DENSITY) != n_values:
+			sys.exit(f'  Unable to parse \"{self._input}\", {len(self.DENSITY)} density values were read in but the grid has {n_values} points.')
+		if self.mmap:
+			try:
+				np.save(sidecar, self.DENSITY)
+				self.DENSITY = np.load(sidecar, mmap_mode='r')
+			except OSError:
+				# e.g. a read-only directory, the density is kept in memory
+				pass
+
+	def _read_density(self, f, n_values):
+		"""Reads the volumetric data from the rest of the open file f into an array of n_values, 
+		parsing about DENSITY_BLOCK characters of whole lines at a time. Returns the values read in"""
+		density = np.empty(n_values, dtype=self.dtype)
+		n = 0
+		while True:
+			lines = f.readlines(DENSITY_BLOCK)
+			if len(lines) == 0:
+				return density[:n]
+			try:
+				values = np.fromstring(''.join(lines), dtype=self.dtype, sep=' ')
+			except ValueError:
+				sys.exit(f'  Unable to parse \"{self._input}\", a density value could not be read in.')
+			if n + len(values) > n_values:
+				sys.exit(f'  Unable to parse \"{self._input}\", more density values were read in than the {n_values} points of the grid.')
+			density[n:n + len(values)] = values
+			n += len(values)
 
 	def _parse_atom_line(self, split_line):
 		"""Parses a line in the cube file containing atom number and coordinates."""
@@ -195,12 +364,6 @@ class CubeParser(DataParser):
 		self.ATOMTYPES.append(atom)
 		self.CARTESIANS.append([x, y, z])
 
-	def _parse_density_line(self, split_line, curr_line):
-		"""Appends density values from a line in the cube file to the DENSITY member array."""
-		for val in split_line:
-			self.DENSITY.append(float(val))
-		self.DENSITY_LINE.append(curr_line)
-
 
 class XYZParser(DataParser):
 	"""Read XYZ Cartesians from an xyz file or chem files similar to xyz."""
@@ -249,14 +412,24 @@ class XYZParser(DataParser):
 
 			
 class cclibParser(DataParser):
-	"""Use the cclib package to extract data from generic computational chemistry output files."""
-	def __init__(self, file, input_format, noH, exclude,  spec_atom_1, spec_atom_2):
+	"""Use the cclib package to extract data from generic computational chemistry output files.
+	By default the last geometry is kept, with steps (see select_steps) the selected geometries of an 
+	optimization or scan are kept as an (n_steps, n_atoms, 3) array of CARTESIANS, their indices in STEPS."""
+	def __init__(self, file, input_format, noH, exclude,  spec_atom_1, spec_atom_2, steps=False):
+		self.STEPS = steps
 		super().__init__(file, input_format, noH, exclude, spec_atom_1, spec_atom_2)
 
 	def parse_input(self):
 		"""Parses input file uses cclib file parser."""
+		import cclib
 		cclib_parsed = cclib.io.ccread(self._input)
-		self.CARTESIANS = np.array(cclib_parsed.atomcoords[-1])
+		if cclib_parsed is None:
+			sys.exit(f'  Unable to parse \"{self._input}\", the file type could not be determined.')
+		if self.STEPS is False:
+			self.CARTESIANS = np.array(cclib_parsed.atomcoords[-1])
+		else:
+			self.STEPS = select_steps(len(cclib_parsed.atomcoords), self.STEPS)
+			self.CARTESIANS = np.array(cclib_parsed.atomcoords)[self.STEPS]
 		for i in cclib_parsed.atomnos:
 			self.ATOMTYPES.append(periodic_table[i])
 
@@ -274,11 +447,39 @@ class RDKitParser(DataParser):
 	def parse_input(self):
 		"""Store cartesians and symbols from mol object"""
 		try:
-			self.ATOMTYPES, self.CARTESIANS = [], []
-			for i in range(self._input.GetNumAtoms()):
-				self.ATOMTYPES.append(self._input.GetAtoms()[i].GetSymbol())
-				pos = self._input.GetConformer().GetAtomPosition(i)
-				self.CARTESIANS.append([pos.x, pos.y, pos.z])
+			self.ATOMTYPES = [atom.GetSymbol() for atom in self._input.GetAtoms()]
+			self.CARTESIANS = self._input.GetConformer().GetPositions()
 		except ValueError:
 			self.ATOMTYPES, self.CARTESIANS = [], []
 			print("Mol object does not have 3D coordinates!")
+
+
+def rdkit_conformers(mol):
+	"""Atom symbols and the coordinates of every conformer of an RDKit mol object as an (n_conf, n_atoms, 3) array"""
+	atoms = [atom.GetSymbol() for atom in mol.GetAtoms()]
+	coords = np.array([conf.GetPositions() for conf in mol.GetConformers()]).reshape(-1, len(atoms), 3)
+	if len(coords) == 0:
+		sys.exit("Mol object does not have 3D coordinates!")
+	return atoms, coords
+
+
+class ArrayParser(DataParser):
+	"""Molecule given directly as atom symbols and coordinates, e.g. one conformer of an ensemble. 
+	An ArrayParser can be passed to dbstep in place of a file name.
+
+	Attributes:
+		ATOMTYPES (numpy array): List of elements present in the molecule
+		CARTESIANS (numpy array): (n_atoms, 3) Cartesian coordinates, or (n_conf, n_atoms, 3) for an ensemble
+	"""
+	def __init__(self, atoms, coords, name='molecule', noH=False, exclude=False, spec_atom_1=1, spec_atom_2=[2]):
+		self._atoms, self._coords = atoms, coords
+		super().__init__(name, 'array', noH, exclude, spec_atom_1, spec_atom_2)
+
+	def parse_input(self):
+		"""Store cartesians and symbols from the arrays"""
+		self.ATOMTYPES = [str(atom) for atom in self._atoms]
+		self.CARTESIANS = np.array(self._coords, dtype=float)
+		del self._atoms, self._coords
+
+	def __str__(self):
+		return str(self._input)
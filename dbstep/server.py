@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+import os, sys, io, json, signal, socket, socketserver, threading, contextlib, functools
+from concurrent.futures import ThreadPoolExecutor, wait
+from optparse import OptionParser
+from dbstep import Dbstep, parse_data
+
+
+"""
+server
+
+Long-running mode, started with python -m dbstep serve, that keeps the interpreter, the imported modules and the
+compiled kernels alive between molecules. Requests are read as JSON lines from stdin (responses are written to
+stdout) or from connections to a local Unix socket (responses are written back on the same connection).
+Each request is one JSON object with either a file path or inline atoms and coordinates, plus any dbstep options:
+
+	{"id": 1, "file": "Et.xyz", "options": {"sterimol": true}}
+	{"id": 2, "atoms": ["C", "H", ...], "coords": [[0.0, 0.0, 0.0], ...], "options": {"volume": true}}
+
+Each response is one JSON line with the id of its request, its results (None if it failed), the error message
+(None if it succeeded) and the output dbstep printed. Requests are computed concurrently by a pool of workers
+and responses are written as they complete, so they can arrive in a different order from the requests.
+"""
+
+
+RESULT_ATTRIBUTES = ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell', 'rows', 'setup_time', 'calc_time']
+
+# options of every request unless the request sets them, files are not written next to the inputs
+DEFAULT_OPTIONS = {'commandline': True}
+
+
+def handle(request, defaults=DEFAULT_OPTIONS):
+	"""Computes one request (a dictionary) and returns its response dictionary. Anything that would stop
+	the program is returned as the error of the response, so one bad request can't stop the server"""
+	response = {'id': request.get('id') if isinstance(request, dict) else None, 'results': None, 'error': None, 'output': ''}
+	output = io.StringIO()
+	try:
+		with contextlib.redirect_stdout(output):
+			if not isinstance(request, dict):
+				raise ValueError("a request must be a JSON object")
+			kwargs = dict(defaults)
+			kwargs.update(request.get('options', {}))
+			if 'file' in request:
+				mol_input = str(request['file'])
+			elif 'atoms' in request and 'coords' in request:
+				mol_input = parse_data.ArrayParser(request['atoms'], request['coords'], request.get('name', 'molecule'))
+			else:
+				raise ValueError('a request needs a "file" or "atoms" and "coords"')
+			mol = Dbstep.dbstep(mol_input, options=Dbstep.set_options(kwargs))
+		response['results'] = {attribute: getattr(mol, attribute) for attribute in RESULT_ATTRIBUTES}
+	except SystemExit as e:
+		response['error'] = str(e)
+	except Exception as e:
+		response['error'] = "{}: {}".format(type(e).__name__, e)
+	response['output'] = output.getvalue()
+	return response
+
+
+# a small calculation run by each worker when it starts, so that the first real request doesn't pay for
+# the imports of the grid code (scipy, numba) and the compilation of the kernels
+WARMUP_REQUEST = {'atoms': ['C', 'H'], 'coords': [[0.0, 0.0, 0.0], [0.0, 0.0, 1.1]], 'options': {'sterimol': True, 'volume': True, 'quiet': True}}
+
+
+def make_executor(n_jobs=1, threads=0, defaults=DEFAULT_OPTIONS):
+	"""Pool that computes the requests. With one job requests are computed in turn by a thread of this process,
+	otherwise by n_jobs worker processes (-1 uses every core), each started once with its kernels compiled and 
+	WARMUP_REQUEST computed. Returns the pool and defaults with the thread count of each worker (threads, 
+	or the cores shared between the workers), which every request needs so that it keeps that count"""
+	if n_jobs is None or n_jobs < 1:
+		n_jobs = os.cpu_count() or 1
+	defaults = dict(defaults, threads=Dbstep.worker_threads(n_jobs, threads))
+	warmup = functools.partial(handle, WARMUP_REQUEST, defaults)
+	if n_jobs == 1:
+		Dbstep.init_worker(defaults['threads'], warmup)
+		# one thread only, the printed output of a request is captured by redirecting stdout of the whole process
+		return ThreadPoolExecutor(max_workers=1), defaults
+	executor = Dbstep.worker_pool(n_jobs, defaults['threads'], warmup)
+	# workers are started on demand, have them all started (and warmed up) before the first request
+	wait([executor.submit(os.getpid) for n in range(n_jobs)])
+	return executor, defaults
+
+
+def serve_stream(executor, lines, write, defaults=DEFAULT_OPTIONS):
+	"""Submits each JSON line of lines to executor and calls write with each JSON response line as
+	it completes. Returns once every request has been answered"""
+	lock = threading.Lock()
+
+	def respond(response):
+		with lock:
+			write(json.dumps(response, default=float) + '\n')
+
+	def done(request_id, answered, future):
+		try:
+			response = future.result()
+		except Exception as e:
+			# e.g. a worker process that died
+			response = {'id': request_id, 'results': None, 'error': "{}: {}".format(type(e).__name__, e), 'output': ''}
+		respond(response)
+		answered.set()
+
+	# set once the response of each request has been written, which is after its future is done
+	answered = []
+	for line in lines:
+		if isinstance(line, bytes): line = line.decode()
+		if len(line.split()) == 0: continue
+		try:
+			request = json.loads(line)
+		except ValueError as e:
+			respond({'id': None, 'results': None, 'error': "invalid JSON request: {}".format(e), 'output': ''})
+			continue
+		answered.append(threading.Event())
+		future = executor.submit(handle, request, defaults)
+		future.add_done_callback(functools.partial(done, request.get('id') if isinstance(request, dict) else None, answered[-1]))
+	for event in answered:
+		event.wait()
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+	"""Answers the JSON line requests of one socket connection"""
+	def handle(self):
+		def write(text):
+			self.wfile.write(text.encode())
+			self.wfile.flush()
+		serve_stream(self.server.executor, self.rfile, write, self.server.defaults)
+
+
+def make_server(path, executor, defaults=DEFAULT_OPTIONS):
+	"""Unix socket server at path, each connection is answered by its own thread using the shared executor"""
+	if not hasattr(socket, 'AF_UNIX'):
+		sys.exit("  Unix sockets are not available on this platform, requests can be sent over stdin instead.")
+	if os.path.exists(path):
+		os.remove(path)
+	server = socketserver.ThreadingUnixStreamServer(path, _StreamHandler)
+	server.daemon_threads = True
+	server.executor, server.defaults = executor, defaults
+	return server
+
+
+def _stop(signum, frame):
+	"""SIGTERM handler, stops the server the way Ctrl-C does (once)"""
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	raise KeyboardInterrupt
+
+
+def main(argv=None):
+	parser = OptionParser(usage="Usage: python -m dbstep serve [options]\n\n"
+		"Reads JSON line requests from stdin (or from connections to --socket) and writes JSON line responses")
+	parser.add_option("--socket", dest="socket", action="store", help="Path of a Unix socket to listen on instead of reading stdin", default=False, metavar="socket")
+	parser.add_option("--jobs", dest="jobs", action="store", help="Number of worker processes computing requests concurrently (default = 1, -1 uses every core)", default=1, type=int, metavar="jobs")
+	parser.add_option("--threads", dest="threads", action="store", help="Number of threads used by the parallel grid kernels of each worker (default = cores shared between workers)", default=0, type=int, metavar="threads")
+	parser.add_option("--cache", dest="cache", action="store", help="SQLite file in which every request caches its results, unless the request sets its own", default=False, metavar="cache")
+	parser.add_option("--cachesize", dest="cachesize", action="store", help="Size limit of the result cache in MB (default = 512)", default=512, type=float, metavar="cachesize")
+	(options, args) = parser.parse_args(argv)
+
+	defaults = dict(DEFAULT_OPTIONS)
+	if options.cache:
+		defaults.update({'cache': options.cache, 'cachesize': options.cachesize})
+
+	# responses are written to the real stdout, requests being computed in this process print into their own buffer
+	stdout = sys.stdout
+	def write(text):
+		stdout.write(text)
+		stdout.flush()
+
+	executor, defaults = make_executor(options.jobs, options.threads, defaults)
+	try:
+		if options.socket:
+			server = make_server(options.socket, executor, defaults)
+			# stopped with Ctrl-C or a SIGTERM, either way the socket file is removed
+			signal.signal(signal.SIGTERM, _stop)
+			sys.stderr.write("   dbstep server listening on {}\n".format(options.socket))
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			finally:
+				server.server_close()
+				os.remove(options.socket)
+		else:
+			serve_stream(executor, sys.stdin, write, defaults)
+	finally:
+		executor.shutdown(wait=True)
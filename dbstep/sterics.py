@@ -1,8 +1,7 @@
 # -*- coding: UTF-8 -*-
 import sys, math
 import numpy as np
-from numba import prange,jit
-import scipy.spatial as spatial	
+from dbstep import kernels
 
 
 """
@@ -12,23 +11,17 @@ Computes steric data: L, Bmin, Bmax, Buried Volume
 """
 
 
-@jit
-def parallel_grid_scan(xy_grid, angle):
-	"""angular sweep over grid points to find Bmin"""
-	rmax = 0.0
-	for i in prange(len(xy_grid)):
-		r = xy_grid[i][0]*math.cos(angle)+xy_grid[i][1]*math.sin(angle)
-		if r > rmax:
-				rmax = r
-	return rmax
-
-
 def grid_round(x, spacing):
 	"""Rounds distances into discrete numbers of grid intervals"""
 	n = 1 / spacing
 	return(round(x*n)/n)
 
 
+def grid_axes(x_min, x_max, y_min, y_max, z_min, z_max, spacing):
+	"""Axis values of a grid spanning the given limits at (as close as possible to) the given spacing"""
+	return [np.linspace(lo, hi, int(1 + round((hi - lo) / spacing))) for lo, hi in [(x_min, x_max), (y_min, y_max), (z_min, z_max)]]
+
+
 def max_dim(coords, radii, options):
 	"""Establishes the smallest cuboid that contains all of the molecule, 
 	if volume is requested, make sure sphere fits fully inside space"""
@@ -80,58 +73,236 @@ def occupied(grid, coords, radii, origin, options):
 	if options.verbose ==True: print("\n   Using a Cartesian grid-spacing of {:5.4f} Angstrom.".format(spacing))
 	if options.verbose ==True: print("   There are {} grid points.".format(len(grid)))
 	
-	idx =  [] 
+	from scipy import spatial
 	point_tree = spatial.cKDTree(grid,balanced_tree=False,compact_nodes=False)
+	# occupancy of each grid point, a voxel is occupied once however many atoms contain it
+	occupied = np.zeros(len(grid), dtype=bool)
 	for n in range(len(coords)):
 		center = coords[n] + origin
-		idx.append(point_tree.query_ball_point(center, radii[n], n_jobs=-1))
-	#construct a list of indices of the grid array that are occupied / unoccupied
-	jdx = [y for x in idx for y in x]
-	if options.qsar: kdx = [i for i in range(len(grid)) if i not in jdx] 
-	
-	# removes duplicates since a voxel can only be occupied once
-	jdx = list(set(jdx))
-	if options.qsar: 
-		kdx = list(set(kdx))
-		onehot = np.zeros(len(grid))
-		for i in jdx:
-			onehot[i] = 1.
+		occupied[np.asarray(point_tree.query_ball_point(center, radii[n], workers=-1), dtype=np.intp)] = True
+	n_occ = int(np.count_nonzero(occupied))
 	
-	if options.verbose: print("   There are {} occupied grid points.".format(len(jdx)))
-	occ_vol = len(jdx) * spacing ** 3
+	if options.verbose: print("   There are {} occupied grid points.".format(n_occ))
+	occ_vol = n_occ * spacing ** 3
 	if options.verbose: print("   Molecular volume is {:5.4f} Ang^3".format(occ_vol))
 	
 	if options.debug:
 		#visualize grid points quickly
 		import pptk
 		u = pptk.viewer(grid)
-		v = pptk.viewer(grid[jdx])
-		if options.qsar: w = pptk.viewer(grid[kdx])
+		v = pptk.viewer(grid[occupied])
+		if options.qsar: w = pptk.viewer(grid[~occupied])
 	
 	if options.qsar:
-		return grid[jdx],grid[kdx],onehot,point_tree
+		return grid[occupied],grid[~occupied],occupied.astype(float),point_tree,occ_vol
 	else:
-		return grid[jdx],point_tree,occ_vol
+		return grid[occupied],point_tree,occ_vol
+
+
+class VoxelGrid:
+	"""Implicit Cartesian grid defined by its x, y and z axis values. Occupancy is held as a boolean
+	array of shape (nx, ny, nz) instead of a KD-tree over every grid point, so the grid itself is
+	never materialized unless a caller asks for it. Sets of grid points are passed around as compact
+	(i, j, k) integer indices and only turned into Cartesian coordinates by cartesians().
+
+	Attributes:
+		x_vals, y_vals, z_vals (numpy array): grid point positions along each axis
+		shape (tuple): number of grid points along x, y and z
+		size (int): total number of grid points
+		index_dtype (numpy dtype): int16, or int32 for grids with more than 32767 points along an axis
+		mask (numpy array of bool): occupancy of each grid point, indexed [i, j, k] -> (x_vals[i], y_vals[j], z_vals[k])
+	"""
+	def __init__(self, x_vals, y_vals, z_vals):
+		self._buffer = np.zeros(0, dtype=bool)
+		self.reset(x_vals, y_vals, z_vals)
+
+	def reset(self, x_vals, y_vals, z_vals):
+		"""Moves the grid to new axis values with every point unoccupied, e.g. for the next conformer or
+		trajectory frame. The occupancy array reuses the memory of the previous one whenever it is large enough"""
+		self.x_vals, self.y_vals, self.z_vals = np.asarray(x_vals), np.asarray(y_vals), np.asarray(z_vals)
+		self.shape = (len(self.x_vals), len(self.y_vals), len(self.z_vals))
+		self.size = self.shape[0] * self.shape[1] * self.shape[2]
+		self.index_dtype = np.dtype(np.int16 if max(self.shape) <= np.iinfo(np.int16).max else np.int32)
+		if self.size > len(self._buffer):
+			self._buffer = np.zeros(self.size, dtype=bool)
+		self.mask = self._buffer[:self.size].reshape(self.shape)
+		self.mask[...] = False
+
+	def _block(self, center, radius):
+		"""Returns the index slices of the sub-block that can lie within radius of center
+		and the squared distance of each of its grid points from center"""
+		slices, sq_dist = [], []
+		for vals, c in zip((self.x_vals, self.y_vals, self.z_vals), center):
+			# pad by one point each side, the distance test below decides membership exactly
+			lo = max(np.searchsorted(vals, c - radius, side='left') - 1, 0)
+			hi = min(np.searchsorted(vals, c + radius, side='right') + 1, len(vals))
+			slices.append(slice(lo, hi))
+			sq_dist.append((vals[lo:hi] - c) ** 2)
+		# summed in x, y, z order to reproduce the distances of a KD-tree ball query
+		dist = sq_dist[0][:, None, None] + sq_dist[1][None, :, None] + sq_dist[2][None, None, :]
+		return tuple(slices), dist
+
+	def stamp(self, center, radius):
+		"""Marks every grid point within radius of center as occupied"""
+		block, dist = self._block(center, radius)
+		self.mask[block] |= dist <= radius ** 2
+
+	def count(self, center, radius, occupied=False):
+		"""Number of grid points (or occupied grid points) within radius of center"""
+		block, dist = self._block(center, radius)
+		inside = dist <= radius ** 2
+		if occupied:
+			inside &= self.mask[block]
+		return int(np.count_nonzero(inside))
+
+	def sq_distances(self, center, radius, occupied=False):
+		"""Squared distances from center of the grid points (or occupied grid points) within radius"""
+		block, dist = self._block(center, radius)
+		inside = dist <= radius ** 2
+		if occupied:
+			inside &= self.mask[block]
+		return dist[inside]
+
+	def indices(self, mask=None):
+		"""(i, j, k) indices of the True points of mask (default: the occupied points) as an (n, 3) array 
+		of index_dtype, in grid order (z slowest, then x, then y). Filled one z-slice at a time so no 
+		full-size int64 temporaries are created"""
+		if mask is None: mask = self.mask
+		index = np.empty((np.count_nonzero(mask), 3), dtype=self.index_dtype)
+		n = 0
+		for k in range(self.shape[2]):
+			i, j = np.nonzero(mask[:,:,k])
+			index[n:n+len(i),0], index[n:n+len(i),1], index[n:n+len(i),2] = i, j, k
+			n += len(i)
+		return index
+
+	def cartesians(self, index):
+		"""Cartesian coordinates of the grid points with (i, j, k) indices"""
+		return np.column_stack((self.x_vals[index[:,0]], self.y_vals[index[:,1]], self.z_vals[index[:,2]]))
+
+	def boundary_points(self):
+		"""Cartesian coordinates of the occupied grid points with at least one unoccupied (or off-grid) 
+		neighbour along x, y or z"""
+		return self.cartesians(self.indices(boundary_mask(self.mask)))
+
+	def points(self):
+		"""All grid points, in the same order as np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)"""
+		return self.cartesians(self.indices(np.ones(self.shape, dtype=bool)))
+
+	def flat_mask(self):
+		"""Occupancy of each grid point in the order returned by points()"""
+		return self.mask.transpose(2, 0, 1).ravel()
+
+	def occupied_points(self):
+		"""Cartesian coordinates of the occupied grid points"""
+		return self.cartesians(self.indices())
+
+
+def boundary_mask(mask):
+	"""Erodes a 3D occupancy mask to its outer shell: voxels that are occupied but not surrounded on all six sides"""
+	padded = np.pad(mask, 1)
+	interior = mask.copy()
+	for axis in range(3):
+		for shift in (-1, 1):
+			interior &= np.roll(padded, shift, axis=axis)[1:-1,1:-1,1:-1]
+	return mask & ~interior
+
+
+def boundary_points(occ_grid):
+	"""Occupied points with at least one unoccupied neighbour along x, y or z. The lattice index of each point
+	is recovered from its coordinates so this works for any occupied grid (VDW or density). Sterimol L, Bmin
+	and Bmax only depend on these points: for any direction in the XY-plane (or up the L-axis) an interior point 
+	always has an occupied neighbour that is at least as far out."""
+	if len(occ_grid) == 0:
+		return occ_grid
+	index = []
+	for axis in range(3):
+		vals = np.unique(occ_grid[:,axis])
+		step = np.min(np.diff(vals)) if len(vals) > 1 else 1.0
+		index.append(np.rint((occ_grid[:,axis] - vals[0]) / step).astype(np.int64))
+	mask = np.zeros([np.max(i) + 1 for i in index], dtype=bool)
+	mask[tuple(index)] = True
+	return occ_grid[boundary_mask(mask)[tuple(index)]]
+
+
+def occupied_voxel(x_vals, y_vals, z_vals, coords, radii, origin, options, voxel=None):
+	"""Uses atomic coordinates and VDW radii to establish which grid voxels are occupied. Each atom
+	is stamped into a boolean occupancy array, giving the same voxels as occupied() at a fraction of the memory.
+	Occupied voxels are returned as compact (i, j, k) indices, use voxel.cartesians() for their coordinates.
+	A VoxelGrid (e.g. from the previous conformer or trajectory frame) can be passed as voxel to reuse its memory"""
+	spacing = options.grid
+	if voxel is not None:
+		voxel.reset(x_vals, y_vals, z_vals)
+	else:
+		voxel = VoxelGrid(x_vals, y_vals, z_vals)
+	if options.verbose ==True: print("\n   Using a Cartesian grid-spacing of {:5.4f} Angstrom.".format(spacing))
+	if options.verbose ==True: print("   There are {} grid points.".format(voxel.size))
 
+	for n in range(len(coords)):
+		voxel.stamp(coords[n] + origin, radii[n])
 
-def occupied_dens(grid, dens, options):
-	"""Uses density cube to establish which grid voxels are occupied (i.e. density is above some isoval, by default 0.002)"""
+	occ_index = voxel.indices()
+	if options.verbose: print("   There are {} occupied grid points.".format(len(occ_index)))
+	occ_vol = len(occ_index) * spacing ** 3
+	if options.verbose: print("   Molecular volume is {:5.4f} Ang^3".format(occ_vol))
+
+	if options.debug:
+		#visualize grid points quickly
+		import pptk
+		v = pptk.viewer(voxel.cartesians(occ_index))
+
+	if options.qsar:
+		onehot = voxel.flat_mask().astype(float)
+		return occ_index, voxel.cartesians(voxel.indices(~voxel.mask)), onehot, voxel, occ_vol
+	else:
+		return occ_index, voxel, occ_vol
+
+
+def density_roi(x_vals, y_vals, z_vals, occupied, radius=None, sterimol=True):
+	"""Slices of a cube grid (padded by one point) that can affect the steric parameters: the bounding box 
+	of the occupied voxels for Sterimol, which is measured from every occupied voxel, and the box around 
+	the sphere of radius about the origin for buried volume, which also counts the unoccupied voxels in it"""
+	block = []
+	for axis, vals in enumerate((x_vals, y_vals, z_vals)):
+		lo, hi = len(vals), 0
+		if sterimol:
+			filled = np.nonzero(np.any(occupied, axis=tuple(a for a in range(3) if a != axis)))[0]
+			if len(filled) > 0:
+				lo, hi = filled[0], filled[-1] + 1
+		if radius is not None:
+			lo = min(lo, np.searchsorted(vals, -radius, side='left'))
+			hi = max(hi, np.searchsorted(vals, radius, side='right'))
+		if lo >= hi:
+			lo, hi = 0, len(vals)
+		block.append(slice(max(lo - 1, 0), min(hi + 1, len(vals))))
+	return tuple(block)
+
+
+def occupied_dens(x_vals, y_vals, z_vals, dens, options, radius=None):
+	"""Uses density cube to establish which grid voxels are occupied (i.e. density is above some isoval, by default 0.002).
+	Cube densities are stored with x slowest and z fastest, which is the [i, j, k] order of a VoxelGrid mask, so the 
+	occupancy is the density array compared with the isovalue. Voxels within a sphere are then counted by the VoxelGrid
+	from the distances of the grid points around the origin, without a KD-tree over the whole cube.
+	The VoxelGrid only covers the region that can affect the results (see density_roi), radius is the largest
+	radius at which buried volume will be measured (None without buried volume).
+	Returns the occupied voxels as compact (i, j, k) indices, the VoxelGrid and the occupied volume of the whole cube"""
 	spacing, isoval = options.grid, options.isoval
-	cube, list = (spacing / 0.529177249) ** 3, []
 	if options.verbose: print("\n   Using a Cartesian grid-spacing of {:5.4f} Angstrom".format(spacing))
 
-	for n, density in enumerate(dens):
-		if density > isoval: list.append(n)
-	occ_vol = len(list) * spacing ** 3
+	occupied = np.reshape(dens, (len(x_vals), len(y_vals), len(z_vals))) > isoval
+	occ_vol = np.count_nonzero(occupied) * spacing ** 3
 	if options.verbose: print("   Molecular volume is {:5.4f} Ang^3".format(occ_vol))
 
-	# quick fix to allow %Vbur calculations on cube files
-	point_tree = spatial.cKDTree(grid, balanced_tree=False, compact_nodes=False)
-	return grid[list], occ_vol, point_tree
+	block = density_roi(x_vals, y_vals, z_vals, occupied, radius, options.sterimol)
+	voxel = VoxelGrid(x_vals[block[0]], y_vals[block[1]], z_vals[block[2]])
+	voxel.mask[...] = occupied[block]
+	if options.verbose: print("   The cube is cropped to {} of its {} grid points.".format(voxel.size, occupied.size))
+	return voxel.indices(), voxel, occ_vol
 
 
 def resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol):
-	"""Resize the grid to accomodate the sphere for volume calculations"""
+	"""Resize the grid to accomodate the sphere for volume calculations. The resized grid is 
+	returned as an (empty) VoxelGrid, grid points are not materialized"""
 	if x_max < options.radius+options.radius*0.1: 
 		x_orig = x_max
 		x_max = options.radius+options.radius*0.1
@@ -178,118 +349,202 @@ def resize_grid(x_max,y_max,z_max,x_min,y_min,z_min,options,mol):
 	x_vals = np.linspace(x_min, x_max, mol.xdim)
 	y_vals = np.linspace(y_min, y_max, mol.ydim)
 	z_vals = np.linspace(z_min, z_max, mol.zdim)
-	grid = np.array(np.meshgrid(x_vals, y_vals, z_vals)).T.reshape(-1,3)
 	
-	return grid
+	return VoxelGrid(x_vals, y_vals, z_vals)
 	
 
-def get_classic_sterimol(coords, radii, atoms):
-	"""Uses standard Verloop definitions and VDW spheres to define L, B1 and B5"""
-	L, Bmax, Bmin, xmax, ymax, cyl, rad_hist_hy,rad_hist_rw, x_hist_rw, y_hist_rw,x_hist_hy, y_hist_hy  = 0.0, 0.0, 0.0, 0.0, 0.0, [], [], [], [], [], [], []
-	for n, coord in enumerate(coords):
-		# L parameter - this is not actually the total length, but the largest distance from the basal XY-plane. Any atoms pointing below this plane (i.e. in the opposite direction) are not counted.
-		# Verloop's original definition does include the VDW of the base atom, which is totally weird and is not done here. There will be a systematic difference vs. literature
-		length = abs(coord[2]) + radii[n]
-		if length > L: L = length
-
-		# B5 parameter
-		x,y,z = coord
-		radius = np.hypot(x,y) + radii[n]
-		if x != 0.0 and y != 0.0:
-			x_hist_hy.append(x)
-			y_hist_hy.append(y)
-			rad_hist_hy.append(radius)
-		rad_hist_rw.append(radii[n])
-		x_hist_rw.append(x)
-		y_hist_rw.append(y)
-		if radius > Bmax:
-			Bmax, xmax, ymax = radius, x, y
-			# don't actually need this for Sterimol. It's used to draw a vector direction along B5 to be displayed in PyMol
-			if x == 0: 
-				theta = 0
-			else: 
-				theta = np.arctan(y/x)
-			if x < 0: theta += math.pi
-			if x != 0. and y!= 0.:
-				x_disp, y_disp = radii[n] * math.cos(theta), radii[n] * math.sin(theta)
-			elif x == 0. and y != 0.:
-				x_disp, y_disp = 0.0, radii[n] * math.sin(theta)
-			elif x != 0. and y == 0.:
-				x_disp, y_disp = radii[n]* math.cos(theta), 0.0
-			else:
-				x_disp, y_disp = radii[n], 0.0
-			xmax += x_disp; ymax += y_disp
+def get_classic_sterimol(coords, radii, atoms, increments=361, hull=False):
+	"""Uses standard Verloop definitions and VDW spheres to define L, B1 and B5. B1 is found by sweeping 
+	increments directions around the L-axis (361 gives 1 degree intervals, 6000 gives 0.06 degrees), with all
+	atom projections evaluated at once. With hull=True B1 is found exactly from the hull of the projected circles"""
+	L, Bmax, Bmin, xmax, ymax, cyl = 0.0, 0.0, 0.0, 0.0, 0.0, []
+	coords, radii = np.asarray(coords, dtype=float), np.asarray(radii, dtype=float)
+	x_vals, y_vals = coords[:,0], coords[:,1]
+
+	# L parameter - this is not actually the total length, but the largest distance from the basal XY-plane. Any atoms pointing below this plane (i.e. in the opposite direction) are not counted.
+	# Verloop's original definition does include the VDW of the base atom, which is totally weird and is not done here. There will be a systematic difference vs. literature
+	L = max(L, np.max(np.abs(coords[:,2]) + radii))
+
+	# B5 parameter
+	hypot = np.hypot(x_vals, y_vals) + radii
+	n = np.argmax(hypot)
+	if hypot[n] > Bmax:
+		Bmax, xmax, ymax = hypot[n], x_vals[n], y_vals[n]
+		x, y = xmax, ymax
+		# don't actually need this for Sterimol. It's used to draw a vector direction along B5 to be displayed in PyMol
+		if x == 0: 
+			theta = 0
+		else: 
+			theta = np.arctan(y/x)
+		if x < 0: theta += math.pi
+		if x != 0. and y!= 0.:
+			x_disp, y_disp = radii[n] * math.cos(theta), radii[n] * math.sin(theta)
+		elif x == 0. and y != 0.:
+			x_disp, y_disp = 0.0, radii[n] * math.sin(theta)
+		elif x != 0. and y == 0.:
+			x_disp, y_disp = radii[n]* math.cos(theta), 0.0
+		else:
+			x_disp, y_disp = radii[n], 0.0
+		xmax += x_disp; ymax += y_disp
 
 	# A nice PyMol cylinder object points along the B5 direction with the appopriate magnitude
 	cyl.append("   CYLINDER, 0., 0., {:5.3f}, {:5.3f}, {:5.3f}, {:5.3f}, {:5.3f}, 1.0, 1.0, 1.0, 1.0, 0.0, 0.0,".format(0.0, xmax, ymax, 0.0, 0.1))
 
 	# Drop the Z coordinates and calculate B1
-	xycoords = [(x,y) for x,y,z in coords]
-	#increments = 6000 # this goes around in 0.06 degree intervals
-	increments = 361 # this goes around in 1 degree intervals
 	angles = np.linspace(-math.pi, -math.pi + 2 * math.pi, increments) # sweep full circle
-	Bmin = sys.float_info.max
-	xmin,ymin = 0,0
-	for angle in angles:
-		angle_val = 0.0
-		for i in range(len(xycoords)):
-			projection = (xycoords[i][0])*math.cos(angle) + (xycoords[i][1])*math.sin(angle)
-			radius = projection + radii[i]
-
-			if radius > angle_val:
-				angle_val, x, y = radius, radius*math.cos(angle),radius*math.sin(angle)
-
-		if Bmin > angle_val:
-			Bmin,xmin,ymin = angle_val,x,y
+	# (angles x atoms) projections of each VDW sphere, the farthest out in each direction defines the width
+	projections = np.outer(np.cos(angles), x_vals) + np.outer(np.sin(angles), y_vals) + radii
+	widths = np.maximum(np.max(projections, axis=1), 0.0)
+	i = np.argmin(widths)
+	Bmin, phi = widths[i], angles[i]
+
+	if hull:
+		exact_Bmin, exact_phi = circle_hull_bmin(x_vals, y_vals, radii, projections, widths, increments)
+		if exact_Bmin is not None and exact_Bmin < Bmin:
+			Bmin, phi = exact_Bmin, exact_phi
+	xmin, ymin = Bmin * math.cos(phi), Bmin * math.sin(phi)
 
 	cyl.append("   CYLINDER, 0., 0., {:5.3f}, {:5.3f}, {:5.3f}, {:5.3f}, {:5.3f}, 1.0, 1.0, 1.0, 0.0, 1.0, 0.0,".format(0.0, xmin, ymin, 0.0, 0.1))
 	return L, Bmax, Bmin, cyl
 
 
-def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False):
+def circle_hull_bmin(x_vals, y_vals, radii, projections, widths, increments):
+	"""Exact minimum width of a set of circles (the projected VDW spheres) over all directions around the L-axis.
+	The width follows one circle between the directions where two circles give equal projections, so its
+	minimum lies at one of these or directly opposite a circle center. Only circles that come within sampling 
+	error of the width of an angular sweep can be on the hull, so candidates are restricted to those."""
+	centers = np.hypot(x_vals, y_vals)
+	step = 2 * math.pi / (increments - 1)
+	slack = (centers + np.max(centers)) * step / 2 + 1e-9
+	active = np.flatnonzero(np.max(projections - widths[:,None], axis=0) >= -slack)
+	x, y, r = x_vals[active], y_vals[active], radii[active]
+
+	# directions directly opposite each circle center
+	candidates = [np.arctan2(y, x)[centers[active] > 0] + math.pi]
+	# directions where two circles project equally: (c_i - c_j).u = r_j - r_i
+	i, j = np.triu_indices(len(active), k=1)
+	dx, dy, dr = x[i] - x[j], y[i] - y[j], r[j] - r[i]
+	rho = np.hypot(dx, dy)
+	ok = (rho > 0) & (np.abs(dr) <= rho)
+	base, offset = np.arctan2(dy[ok], dx[ok]), np.arccos(dr[ok] / rho[ok])
+	candidates += [base + offset, base - offset]
+	candidates = np.concatenate(candidates)
+	if len(candidates) == 0:
+		return None, None
+
+	exact = np.max(np.outer(np.cos(candidates), x_vals) + np.outer(np.sin(candidates), y_vals) + radii, axis=1)
+	# by definition can't have zero radius
+	positive = np.flatnonzero(exact > 0.0)
+	if len(positive) == 0:
+		return None, None
+	k = positive[np.argmin(exact[positive])]
+	return exact[k], math.atan2(math.sin(candidates[k]), math.cos(candidates[k]))
+
+
+def convex_hull_2d(xy):
+	"""Vertices of the convex hull of a set of 2D points in counter-clockwise order (monotone chain).
+	Points are sorted once and only the lowest and highest point of each column are walked"""
+	xy = xy[np.lexsort((xy[:,1], xy[:,0]))]
+	first = np.flatnonzero(np.r_[True, xy[1:,0] != xy[:-1,0]])
+	last = np.r_[first[1:] - 1, len(xy) - 1]
+
+	def chain(points):
+		hull = []
+		for p in points:
+			while len(hull) > 1 and (hull[-1][0]-hull[-2][0])*(p[1]-hull[-2][1]) - (hull[-1][1]-hull[-2][1])*(p[0]-hull[-2][0]) <= 0:
+				hull.pop()
+			hull.append(p)
+		return hull
+
+	lower = chain(xy[first].tolist())
+	upper = chain(xy[last][::-1].tolist())
+	if lower[-1] == upper[0]: upper = upper[1:]
+	if len(upper) > 0 and upper[-1] == lower[0]: upper = upper[:-1]
+	return np.array(lower + upper)
+
+
+def hull_bmin(hull):
+	"""Exact minimum over all directions of the farthest projection of a convex polygon (Bmin).
+	Between hull edge normals the support function follows a single vertex and is concave wherever it 
+	is positive, so the minimum lies along one of the outward edge normals. This only holds when the origin
+	is strictly inside the polygon (every edge normal support is positive). Otherwise, e.g. for a strip or
+	--pos slice lying to one side of the L-axis, the support function falls to zero and below between 
+	the edge normals and None is returned so that the angular sweep is used. Returns Bmin and its angle"""
+	edges = np.roll(hull, -1, axis=0) - hull
+	normals = np.column_stack((edges[:,1], -edges[:,0])) / np.hypot(edges[:,0], edges[:,1])[:,None]
+	support = np.max(hull @ normals.T, axis=0)
+	if np.any(support <= 0.0):
+		return None, None
+	i = np.argmin(support)
+	return support[i], math.atan2(normals[i][1], normals[i][0])
+
+
+def sort_z(occ_grid):
+	"""Orders occupied points along the L-axis so that any horizontal strip of the grid is a contiguous slice.
+	Returns the sorted points and their (contiguous) z values to be searched"""
+	occ_grid = occ_grid[np.argsort(occ_grid[:,2], kind='stable')]
+	return occ_grid, np.ascontiguousarray(occ_grid[:,2])
+
+
+def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False, hull=False, increments=361, z_index=None):
 	"""Uses grid occupancy to define Sterimol L, B1 and B5 parameters. If the grid-spacing is small enough this should be close to the
 	conventional values above when the grid occupancy is based on VDW radii. The real advantage is that the isodensity surface can be used,
 	which does not require VDW radii, and this also looks something a bit closer to a solvent-accessible surface than the sum-of-spheres.
 	Also B1 can be defined in a physically more # meaningful way than the traditional approach. This method can take horizontal slices to
-	evaluate these parameters along the L-axis, which is also a nightmare with the conventional definition."""
+	evaluate these parameters along the L-axis, which is also a nightmare with the conventional definition.
+	With hull=True Bmin and Bmax are found exactly from the convex hull of the projected slice rather than
+	by an angular sweep in 1 degree increments. If occ_grid has been ordered with sort_z its z values can be 
+	passed as z_index and strips are taken as slices rather than by testing every point."""
 	
 	L, Bmax, Bmin, xmax, ymax, zmax, xmin, ymin, cyl = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, []
 
 	# this is a layer of the occupancy grid between Z-limits
 	if strip_width != 0: 
-		xy_grid = np.array([(x,y,z) for x,y,z in occ_grid if z <= R + strip_width and z > R - strip_width])
+		if z_index is not None:
+			xy_grid = occ_grid[np.searchsorted(z_index, R - strip_width, side='right'):np.searchsorted(z_index, R + strip_width, side='right')]
+		else:
+			xy_grid = kernels.strip(kernels.as_points(occ_grid), R - strip_width, R + strip_width)
 	else: 
 		xy_grid = occ_grid
 	
 	if measure_pos:
-		xy_grid = np.array([(x,y,z) for x,y,z in occ_grid if z >= 0])
+		if z_index is not None:
+			xy_grid = occ_grid[np.searchsorted(z_index, 0, side='left'):]
+		else:
+			xy_grid = occ_grid[occ_grid[:,2] >= 0]
 
 	if len(xy_grid) > 0:
-		#radii = map(lambda x: math.sqrt(x[0]**2+x[1]**2), xy_grid)
-		radii = [math.sqrt(x**2+y**2) for x,y,z in xy_grid]
-		Bmax, imax = max(radii), np.argmax(radii)
-		xmax, ymax, zmax = xy_grid[imax]
-		#print(Bmax, math.sqrt(xmax**2+ymax**2))
-		L = max(map(lambda x: x[2], xy_grid))
+		L = np.max(xy_grid[:,2])
+		Bmin = None
+		if hull:
+			# only the vertices of the projected convex hull can define Bmin and Bmax
+			xy_hull = convex_hull_2d(xy_grid[:,:2])
+			radii = np.sqrt(xy_hull[:,0]**2 + xy_hull[:,1]**2)
+			imax = np.argmax(radii)
+			Bmax, (xmax, ymax) = radii[imax], xy_hull[imax]
+			if len(xy_hull) > 2:
+				Bmin, phi = hull_bmin(xy_hull)
+			if Bmin is not None:
+				xmin, ymin = Bmin * math.cos(phi), Bmin * math.sin(phi)
+		else:
+			radii = np.sqrt(xy_grid[:,0]**2 + xy_grid[:,1]**2)
+			Bmax, imax = np.max(radii), np.argmax(radii)
+			xmax, ymax, zmax = xy_grid[imax]
 
 		# Go around in angle increments and record the farthest out point in each slice
-		increments = 361
-		angles = np.linspace(-math.pi, -math.pi+2*math.pi, increments) # sweep full circle
-
-		Bmin = sys.float_info.max
-		xmin,ymin = 0,0
-		max_r, max_phi = [], []
-
-		for angle in angles:
-			rmax = parallel_grid_scan(xy_grid,angle)
+		# (also used if the projected hull is degenerate)
+		if Bmin is None:
+			angles = np.linspace(-math.pi, -math.pi+2*math.pi, increments) # sweep full circle
 
-			if rmax != 0.0: # by definition can't have zero radius
-				max_r.append(rmax)
-				max_phi.append(angle)
+			Bmin = sys.float_info.max
+			xmin,ymin = 0,0
+			rmax = kernels.angular_sweep(kernels.as_points(xy_grid), angles)
+			# by definition can't have zero radius
+			max_r, max_phi = rmax[rmax != 0.0], angles[rmax != 0.0]
 
-		if len(max_r) > 0:
-			Bmin = min(max_r)
-			xmin, ymin = Bmin * math.cos(max_phi[np.argmin(max_r)]), Bmin * math.sin(max_phi[np.argmin(max_r)])
+			if len(max_r) > 0:
+				Bmin = np.min(max_r)
+				xmin, ymin = Bmin * math.cos(max_phi[np.argmin(max_r)]), Bmin * math.sin(max_phi[np.argmin(max_r)])
 
 	elif len(xy_grid) == 0:
 		Bmin, xmin, ymin, Bmax, xmax, ymax, L = 0,0,0,0,0,0,0
@@ -306,8 +561,32 @@ def get_cube_sterimol(occ_grid, R, spacing, strip_width, measure_pos=False):
 	return L, Bmax, Bmin, cyl
 
 
-def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
-	""" Read which grid points occupy sphere"""
+class RadialCounts:
+	"""Sorted squared distances of the grid points and occupied grid points from the origin, out to
+	the largest radius of a scan. The number of points within any radius is then a binary search,
+	so a scan over many radii costs about the same as a single radius."""
+	def __init__(self, occ_grid, point_tree, origin, radius):
+		if isinstance(point_tree, VoxelGrid):
+			tot_dist = point_tree.sq_distances(origin, radius)
+			occ_dist = point_tree.sq_distances(origin, radius, occupied=True)
+		else:
+			tot_dist = kernels.sq_distances(kernels.as_points(point_tree.data), origin)
+			occ_dist = kernels.sq_distances(kernels.as_points(occ_grid), origin)
+		self.tot_dist = np.sort(tot_dist[tot_dist <= radius ** 2])
+		self.occ_dist = np.sort(occ_dist[occ_dist <= radius ** 2])
+
+	def total(self, R):
+		"""Number of grid points within R of the origin"""
+		return int(np.searchsorted(self.tot_dist, R ** 2, side='right'))
+
+	def occupied(self, R):
+		"""Number of occupied grid points within R of the origin"""
+		return int(np.searchsorted(self.occ_dist, R ** 2, side='right'))
+
+
+def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options, counts=None):
+	""" Read which grid points occupy sphere. If a RadialCounts object is supplied (e.g. during a scan)
+	voxels are counted from it instead of querying the grid"""
 	verbose = options.verbose
 	
 	#if doing a scan, use scan radius for volume
@@ -319,11 +598,21 @@ def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
 	cube = spacing ** 3 # cube 
 	
 	# Find total points in the grid within a sphere radius R
-	n_voxel = len(point_tree.query_ball_point(origin, R))
+	if counts is not None:
+		n_voxel = counts.total(R)
+	elif isinstance(point_tree, VoxelGrid):
+		voxel = point_tree
+		n_voxel = voxel.count(origin, R)
+	else:
+		n_voxel = len(point_tree.query_ball_point(origin, R))
 	tot_vol = n_voxel * cube
 	# Find occupied points within the same spherical volume
-	point_tree = spatial.cKDTree(occ_grid,balanced_tree=False,compact_nodes=False)
-	n_occ = len(point_tree.query_ball_point(origin, R, n_jobs=-1))
+	if counts is not None:
+		n_occ = counts.occupied(R)
+	elif isinstance(point_tree, VoxelGrid):
+		n_occ = voxel.count(origin, R, occupied=True)
+	else:
+		n_occ = kernels.count_within(kernels.as_points(occ_grid), origin, R ** 2)
 	occ_vol = n_occ * cube
 	free_vol = tot_vol - occ_vol 
 	percent_buried_vol = occ_vol / tot_vol * 100.0
@@ -336,18 +625,25 @@ def buried_vol(occ_grid, point_tree, origin, rad, strip_width, options):
 	# along the L-axis is being performed
 	if strip_width != 0.0:
 		shell_vol = 4 / 3 * math.pi * ((R + 0.5 * strip_width) ** 3 - (R - 0.5 * strip_width) ** 3)
-		point_tree = spatial.cKDTree(occ_grid,balanced_tree=False,compact_nodes=False)
 		R_pos = R + 0.5 * strip_width
 		if R < strip_width: 
 			R_neg = 0.0
 		else:
 			R_neg = R - 0.5 * strip_width
-		shell_occ = len(point_tree.query_ball_point(origin, R_pos, n_jobs=-1)) - len(point_tree.query_ball_point(origin, R_neg, n_jobs=-1))
-		if options.debug:
+		if counts is not None:
+			shell_occ = counts.occupied(R_pos) - counts.occupied(R_neg)
+		elif isinstance(point_tree, VoxelGrid):
+			shell_occ = voxel.count(origin, R_pos, occupied=True) - voxel.count(origin, R_neg, occupied=True)
+		else:
+			occ_points = kernels.as_points(occ_grid)
+			shell_occ = kernels.count_within(occ_points, origin, R_pos ** 2) - kernels.count_within(occ_points, origin, R_neg ** 2)
+		if options.debug and counts is None and not isinstance(point_tree, VoxelGrid):
 			# this may take a while
 			import pptk
-			a = point_tree.query_ball_point(origin,R_pos , n_jobs=-1)
-			b = point_tree.query_ball_point(origin,R_neg, n_jobs=-1)
+			from scipy import spatial
+			point_tree = spatial.cKDTree(occ_grid,balanced_tree=False,compact_nodes=False)
+			a = point_tree.query_ball_point(origin,R_pos , workers=-1)
+			b = point_tree.query_ball_point(origin,R_neg, workers=-1)
 			for pt in b:
 				if pt in a:
 					a.remove(pt)
@@ -1,6 +1,8 @@
 # -*- coding: UTF-8 -*-
-import os
+import os, sys, csv, json, shutil
+import numpy as np
 from dbstep.constants import BOHR_TO_ANG
+from dbstep.parse_data import open_input, split_ext
 
 """
 writer
@@ -10,6 +12,10 @@ Contains classes and methods to write data to files
 """
 
 
+# size in bytes of the blocks in which the volumetric data of a cube file is copied
+COPY_BLOCK = 1 << 20
+
+
 class Logger:
 	"""Enables output to terminal and to text file"""
 	# Designated initializer 
@@ -22,51 +28,112 @@ class Logger:
 
 
 class WriteCubeData:
-	""" Write new cube file of translated, rotated molecule for PyMOL """
+	""" Write new cube file of translated, rotated molecule for PyMOL. The header is written for the new 
+	coordinates and the volumetric data is copied from the original cube in binary blocks without being parsed """
 	def __init__(self, file, cube):
 		self.FORMAT = 'cube'
-		oldfile = open(file+"."+self.FORMAT,"r")
-		oldlines = oldfile.readlines()
-		molfile = open(file+"_radius."+self.FORMAT,"w")
-		# write new coordinates to file
-		for line in oldlines[0:2]:
-			molfile.write(line)
-
-		dims = [cube.xdim,cube.ydim,cube.zdim]
-		molfile.write("{:5} {:11.6f} {:11.6f} {:11.6f} {:4}".format(len(cube.ATOMNUM),cube.ORIGIN[0] / BOHR_TO_ANG, cube.ORIGIN[1] / BOHR_TO_ANG, cube.ORIGIN[2] / BOHR_TO_ANG, 1)+'\n')
-		for i in range(len(cube.INCREMENTS)):
-			molfile.write("{:5} {:11.6f} {:11.6f} {:11.6f}".format(dims[i],cube.INCREMENTS[i][0] / BOHR_TO_ANG,cube.INCREMENTS[i][1] / BOHR_TO_ANG,cube.INCREMENTS[i][2] / BOHR_TO_ANG)+'\n')
-		for i in range(len(cube.CARTESIANS)):
-			x = cube.CARTESIANS[i][0] / BOHR_TO_ANG
-			y = cube.CARTESIANS[i][1] / BOHR_TO_ANG
-			z = cube.CARTESIANS[i][2] / BOHR_TO_ANG
-			molfile.write("{:5} {:11.6f} {:11.6f} {:11.6f} {:11.6f}".format(cube.ATOMNUM[i],float(cube.ATOMNUM[i]),x,y,z)+'\n')
-
-
-		for line in cube.DENSITY_LINE:
-			molfile.write(line)
-
-		# there may well be a fast way to do this directly from the 3D array of X,Y,Z points
-		# see http://paulbourke.net/dataformats/cube/
-		# for x in xvals:
-		# 	for y in yvals:
-		# 		width = []
-		# 		for z in zvals:
-		# 			width.append((x**2 + y**2)**0.5)
-		# 		# for cube print formatting
-		# 		list_of_widths = itertools.zip_longest(*(iter(width),) * 6)
-		# 		for widths in list_of_widths:
-		# 			outline = ''
-		# 			for val in widths:
-		# 				if val != None:
-		# 					outline += str('  {:10.5E}'.format(val))
-		# 			molfile.write('\n'+outline)
-		molfile.close()
+		# the original cube (which may be compressed) is the one that was parsed
+		with open_input(cube._input, binary=True) as oldfile, open(file+"_radius."+self.FORMAT,"wb") as molfile:
+			# the two title lines are kept
+			for n in range(2):
+				molfile.write(oldfile.readline())
+
+			# write new coordinates to file
+			dims = [cube.xdim,cube.ydim,cube.zdim]
+			header = ["{:5} {:11.6f} {:11.6f} {:11.6f} {:4}".format(len(cube.ATOMNUM),cube.ORIGIN[0] / BOHR_TO_ANG, cube.ORIGIN[1] / BOHR_TO_ANG, cube.ORIGIN[2] / BOHR_TO_ANG, 1)]
+			for i in range(len(cube.INCREMENTS)):
+				header.append("{:5} {:11.6f} {:11.6f} {:11.6f}".format(dims[i],cube.INCREMENTS[i][0] / BOHR_TO_ANG,cube.INCREMENTS[i][1] / BOHR_TO_ANG,cube.INCREMENTS[i][2] / BOHR_TO_ANG))
+			for i in range(len(cube.CARTESIANS)):
+				x = cube.CARTESIANS[i][0] / BOHR_TO_ANG
+				y = cube.CARTESIANS[i][1] / BOHR_TO_ANG
+				z = cube.CARTESIANS[i][2] / BOHR_TO_ANG
+				header.append("{:5} {:11.6f} {:11.6f} {:11.6f} {:11.6f}".format(cube.ATOMNUM[i],float(cube.ATOMNUM[i]),x,y,z))
+			molfile.write(("\n".join(header) + "\n").encode())
+
+			# the rest of the original header is skipped and its volumetric data copied across unchanged
+			for n in range(cube.HEADER_LINES - 2):
+				oldfile.readline()
+			shutil.copyfileobj(oldfile, molfile, COPY_BLOCK)
+
+
+class ResultSink:
+	"""Writes steric results as a table with one row per molecule (per radius for a scan) to a
+	.csv, .jsonl or .parquet file (parquet requires pyarrow), which can be read directly by pandas or Arrow.
+	Rows are buffered and written every flush_every rows, so a large screen streams to disk in constant memory.
+
+	Use as a context manager, or call close() when done:
+		with ResultSink('results.csv') as sink:
+			for result in dbstep.batch(files):
+				sink.add(result.mol)
+	"""
+	COLUMNS = ['file', 'R', 'L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']
+
+	def __init__(self, path, flush_every=1000):
+		self.path, self.flush_every = path, max(1, int(flush_every))
+		self.FORMAT = os.path.splitext(path)[1][1:].lower()
+		self.n_rows, self._rows, self._parquet = 0, [], None
+		if self.FORMAT == 'parquet':
+			try:
+				import pyarrow, pyarrow.parquet
+			except ModuleNotFoundError as e:
+				sys.exit(f"  {e}, which is needed to write {path}. Please install pyarrow or use a .csv or .jsonl file.")
+			self._schema = pyarrow.schema([('file', pyarrow.string())] + [(column, pyarrow.float64()) for column in self.COLUMNS[1:]])
+			self._parquet = pyarrow.parquet.ParquetWriter(path, self._schema)
+		elif self.FORMAT in ['csv', 'jsonl']:
+			self._file = open(path, 'w', newline='')
+			if self.FORMAT == 'csv':
+				self._csv = csv.writer(self._file)
+				self._csv.writerow(self.COLUMNS)
+		else:
+			sys.exit(f"  Can't write results to {path}, use a .csv, .jsonl or .parquet file.")
+
+	def add(self, mol, name=None):
+		"""Adds the results of a dbstep object, name defaults to its input file (or molecule name)"""
+		name = str(mol.file) if name is None else str(name)
+		for rad, bur_vol, bur_shell, Bmin, Bmax, L in mol.rows:
+			self.write([name, rad, L, Bmin, Bmax, mol.occ_vol, bur_vol, bur_shell])
+
+	def write(self, row):
+		"""Adds a row of values in the order of COLUMNS, values that were not computed (False or None) are left empty"""
+		row = [row[0]] + [None if value is False or value is None else float(value) for value in row[1:]]
+		self._rows.append(row)
+		self.n_rows += 1
+		if len(self._rows) >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+		"""Writes the buffered rows to disk"""
+		if len(self._rows) == 0: return
+		if self.FORMAT == 'parquet':
+			import pyarrow
+			columns = list(zip(*self._rows))
+			table = pyarrow.Table.from_arrays([pyarrow.array(list(values), type=field.type) for values, field in zip(columns, self._schema)], schema=self._schema)
+			self._parquet.write_table(table)
+		elif self.FORMAT == 'csv':
+			self._csv.writerows([['' if value is None else value for value in row] for row in self._rows])
+			self._file.flush()
+		else:
+			self._file.write(''.join(json.dumps(dict(zip(self.COLUMNS, row))) + '\n' for row in self._rows))
+			self._file.flush()
+		self._rows = []
+
+	def close(self):
+		self.flush()
+		if self._parquet is not None:
+			self._parquet.close()
+		else:
+			self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
 
 
 def pymol_export(file, mol, spheres, cylinders, isoval, visv, viss):
 	"""Outputs a python script that can be imported into PyMol (with 'run script.py')"""
-	base, ext = os.path.splitext(file)
+	base, ext = split_ext(file)
 
 	log = Logger(base, "py", "steric")
 	log.Writeonlyfile('from pymol.cgo import *')
@@ -171,7 +238,7 @@ def pymol_export(file, mol, spheres, cylinders, isoval, visv, viss):
 			log.Writeonlyfile('cgoCircle(r='+r+',z='+z+',cr='+cr+',cg='+cg+',cb=0.0)')
 
 	full_path = os.path.abspath(file)
-	name, ext = os.path.splitext(full_path)
+	name, ext = split_ext(full_path)
 
 	if ext == '.cube':
 		log.Writeonlyfile('\ncmd.load("'+full_path+'", '+'"dens"'+')')
@@ -184,9 +251,35 @@ def pymol_export(file, mol, spheres, cylinders, isoval, visv, viss):
 	log.Writeonlyfile('cmd.set("orthoscopic", "on")')
 
 
+def qsar_export(path, mol, points, probe='Ar'):
+	"""Writes the molecule once and the position of the probe atom at each unoccupied grid point of a QSAR 
+	grid to a single .npz file, in place of an xyz file for every grid point. It holds atoms and coords 
+	(the molecule), probe (the probe element), points (the (n, 3) probe positions) and reference (a probe 
+	position 100 Angstrom away along each axis). Members are stored uncompressed, so the points can be 
+	memory-mapped from the file and a job can read a slice of them without the rest being read 
+	(see parse_data.read_qsar_grid)"""
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+	reference = (points[-1] if len(points) > 0 else np.zeros(3)) + 100
+	np.savez(path, atoms=np.asarray(mol.ATOMTYPES, dtype=str), coords=np.asarray(mol.CARTESIANS, dtype=np.float64),
+		probe=np.array(probe), points=points, reference=reference)
+
+
+def onehot_export(path, rows, n_points):
+	"""Writes the one-hot grid occupancy of a set of molecules measured on the same QSAR grid (--gridsize) as
+	an (n_molecules x n_points) sparse matrix of int8, saved with scipy.sparse.save_npz and read back with
+	scipy.sparse.load_npz for use as ML features. Each of rows holds the indices of the occupied grid points 
+	of one molecule. Returns the matrix"""
+	from scipy import sparse
+	indptr = np.concatenate(([0], np.cumsum([len(row) for row in rows]))).astype(np.int64)
+	indices = np.concatenate([np.asarray(row, dtype=np.int64) for row in rows]) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+	matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(len(rows), n_points))
+	sparse.save_npz(path, matrix)
+	return matrix
+
+
 def xyz_export(file,mol):
 	"""Write xyz coordinates of molecule to file"""
-	name, ext = os.path.splitext(file)
+	name, ext = split_ext(file)
 	log = Logger(name, "xyz", "transform")
 	log.Writeonlyfile(str(len(mol.ATOMTYPES)))
 	log.Writeonlyfile(name.split('/')[-1].split('\\')[-1])
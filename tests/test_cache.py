@@ -0,0 +1,45 @@
+import pytest
+
+from dbstep import Dbstep
+from dbstep.cache import ResultCache
+
+
+xyz_dir = 'dbstep/examples/'
+
+
+@pytest.mark.parametrize("kwargs", [
+	{'sterimol': True},
+	{'sterimol': True, 'volume': True, 'scan': '0.0:3.0:1.0'},
+	{'volume': True, 'measure': 'classic'},
+])
+def test_cache_hit_matches_computed(tmp_path, capsys, kwargs):
+	kwargs.update({'grid': 0.1, 'commandline': True, 'cache': str(tmp_path / 'cache.db')})
+	computed = Dbstep.dbstep(xyz_dir + 'Et.xyz', **kwargs)
+	computed_output = capsys.readouterr().out
+	cached = Dbstep.dbstep(xyz_dir + 'Et.xyz', **kwargs)
+	cached_output = capsys.readouterr().out
+
+	assert len(ResultCache(kwargs['cache'])) == 1
+	assert cached_output == computed_output
+	for attr in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+		assert getattr(cached, attr) == getattr(computed, attr)
+
+
+def test_cache_key_depends_on_settings_and_geometry(tmp_path):
+	cache = str(tmp_path / 'cache.db')
+	for kwargs in [{'grid': 0.1}, {'grid': 0.1, 'verbose': True, 'timing': True}, {'grid': 0.2}, {'grid': 0.1, 'noH': True}]:
+		Dbstep.dbstep(xyz_dir + 'Et.xyz', sterimol=True, commandline=True, quiet=True, cache=cache, **kwargs)
+	Dbstep.dbstep(xyz_dir + 'Ph.xyz', sterimol=True, commandline=True, quiet=True, cache=cache, grid=0.1)
+	# printing options do not change the key, the grid spacing, removal of H and the geometry do
+	assert len(ResultCache(cache)) == 4
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+	# room for two of these results
+	cache = ResultCache(str(tmp_path / 'cache.db'), max_size=300 / 1024 ** 2)
+	for key in ['a', 'b', 'c']:
+		cache.put(key, {'rows': [[1.0] * 20]})
+	cache.get('b')
+	cache.put('d', {'rows': [[1.0] * 20]})
+	assert len(cache) == 2
+	assert cache.get('d') is not None and cache.get('b') is not None
@@ -101,3 +101,14 @@ def test_rotate_mol(vector_to_rotate):
 
 	assert new_coords[1][0] == 0
 	assert new_coords[1][1] == 0
+
+
+@pytest.mark.parametrize("spec_atom_2, atom3", [([2], False), ([2], 3), ([2, 4], 5), ([3], '6')])
+def test_align_ensemble_matches_rotate_mol(rng, spec_atom_2, atom3):
+	coords = rng.normal(scale=2.0, size=(16, 8, 3))
+	aligned = calculator.align_ensemble(coords, 1, spec_atom_2, atom3)
+	for conformer, actual in zip(coords, aligned):
+		translated = conformer - conformer[0]
+		end_point = calculator.point_vec(translated, spec_atom_2)
+		expected = calculator.rotate_mol(translated, 1, end_point, atom3=atom3)
+		assert np.array_equal(actual, expected)
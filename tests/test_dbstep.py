@@ -1,6 +1,7 @@
 import pytest
 
-from dbstep import Dbstep
+from dbstep import Dbstep, parse_data, kernels
+from dbstep.constants import periodic_table
 import numpy as np
 
 class DbstepShell:
@@ -117,3 +118,239 @@ class TestAgainstVerloop:
 			values are from each other on failure.
 		"""
 		assert np.round(abs(value1 - value2), 2) <= tolerance
+
+
+class TestBatch:
+	"""Tests batch"""
+	files = ['dbstep/examples/Et.xyz', 'dbstep/examples/Ph.xyz']
+	kwargs = {'sterimol': True, 'grid': 0.1, 'commandline': True, 'quiet': True}
+
+	@pytest.fixture
+	def inputs(self, tmp_path):
+		bad_input = tmp_path / 'bad_input.xyz'
+		bad_input.write_text("1\n\nC 0.0 0.0 0.0\n")
+		return [self.files[0], str(bad_input), self.files[1]]
+
+	@pytest.mark.parametrize("n_jobs, ordered", [(1, True), (2, True), (2, False)])
+	def test_batch_matches_single_runs(self, inputs, n_jobs, ordered):
+		results = list(Dbstep.batch(inputs, n_jobs=n_jobs, ordered=ordered, **self.kwargs))
+		if ordered:
+			assert [result.index for result in results] == [0, 1, 2]
+		results = sorted(results, key=lambda result: result.index)
+		assert [result.input for result in results] == inputs
+		for result in [results[0], results[2]]:
+			expected = Dbstep.dbstep(result.input, **self.kwargs)
+			assert result.error is None
+			assert (result.mol.L, result.mol.Bmin, result.mol.Bmax) == (expected.L, expected.Bmin, expected.Bmax)
+		assert results[1].mol is None
+		assert 'should have at least 2 atom(s)' in results[1].error
+
+	def test_batch_copies_options(self):
+		options = Dbstep.set_options(dict(self.kwargs))
+		results = list(Dbstep.batch(self.files, options=options))
+		assert options.spec_atom_2 is False
+		assert results[0].mol.options is not results[1].mol.options
+
+	def test_batch_shares_cores_between_workers(self, monkeypatch):
+		monkeypatch.setattr(Dbstep.os, 'cpu_count', lambda: 4)
+		results = list(Dbstep.batch(self.files, n_jobs=2, **self.kwargs))
+		assert [result.mol.options.threads for result in results] == [2, 2]
+
+	@pytest.mark.skipif(not kernels.HAVE_NUMBA, reason="numba is not installed")
+	def test_worker_keeps_thread_count(self, monkeypatch):
+		# spawned workers start numba with 4 threads, set to 2 for the batch
+		monkeypatch.setenv('NUMBA_NUM_THREADS', '4')
+		with Dbstep.worker_pool(1, 2) as executor:
+			result = executor.submit(Dbstep._batch_job, 0, self.files[0], Dbstep.set_options(dict(self.kwargs))).result()
+			assert result.error is None and executor.submit(kernels.get_threads).result() == 2
+
+	def test_batch_reports_bare_exit(self):
+		result, = Dbstep.batch(self.files[:1], scan='bad', **self.kwargs)
+		assert result.mol is None and result.error == "Can't read your scan request. Try something like --scan 3:5:0.25"
+
+	def test_run_warns_jobs_are_ignored(self, capsys):
+		Dbstep.run(self.files[:1], Dbstep.set_options(dict(self.kwargs, traj=True, jobs=2)))
+		assert '--jobs has no effect' in capsys.readouterr().out
+
+	@pytest.mark.parametrize("jobs", [1, 2])
+	def test_run_writes_onehot_matrix(self, tmp_path, monkeypatch, jobs):
+		import shutil
+		from scipy import sparse
+		for file in self.files: shutil.copy(file, tmp_path)
+		monkeypatch.chdir(tmp_path)
+		files = ['Ph.xyz', 'Et.xyz']
+		kwargs = {'qsar': True, 'qsarformat': 'npz', 'gridsize': '-4,8:-6,6:-6,6', 'commandline': True, 'quiet': True}
+		Dbstep.run(files, Dbstep.set_options(dict(kwargs, jobs=jobs)))
+		matrix = sparse.load_npz('qsar_onehot.npz')
+		assert (tmp_path / 'qsar_onehot.txt').read_text().splitlines() == files
+		# each row is the occupancy of its molecule on the shared grid
+		for row, file in zip(matrix.toarray(), files):
+			mol = Dbstep.dbstep(file, **kwargs)
+			assert matrix.shape == (2, len(mol.onehot_grid))
+			assert np.array_equal(np.flatnonzero(row), np.flatnonzero(mol.onehot_grid))
+		assert matrix.nnz > 0 and not np.array_equal(matrix.getrow(0).indices, matrix.getrow(1).indices)
+
+
+class TestEnsemble:
+	"""Tests ensemble"""
+	kwargs = {'sterimol': True, 'volume': True, 'grid': 0.1, 'commandline': True, 'quiet': True}
+
+	@pytest.fixture
+	def conformers(self):
+		from scipy.spatial.transform import Rotation as R
+		single = Dbstep.dbstep('dbstep/examples/Et.xyz', **self.kwargs)
+		mol = parse_data.read_input('dbstep/examples/Et.xyz', '.xyz', Dbstep.set_options({}))
+		coords = np.array([R.from_euler('xyz', [n, 2 * n, 3 * n]).apply(mol.CARTESIANS) + n for n in range(3)])
+		return single, mol.ATOMTYPES, coords
+
+	@pytest.mark.parametrize("extra", [{}, {'engine': 'voxel'}, {'atom3': 3}, {'noH': True, 'scan': '0:2:1'}])
+	def test_conformers_match_single_runs(self, conformers, extra):
+		single, atoms, coords = conformers
+		ensemble = Dbstep.ensemble(atoms, coords, **self.kwargs, **extra)
+		assert len(ensemble.conformers) == 3
+		for n, conformer in enumerate(coords):
+			# each conformer is measured on its own grid, as a separate run would be
+			expected = Dbstep.dbstep(parse_data.ArrayParser(atoms, conformer), **self.kwargs, **extra)
+			for param in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+				assert np.array_equal(getattr(ensemble, param)[n], getattr(expected, param))
+		if not extra:
+			assert ensemble.Bmin.shape == (3,)
+			for param in ['L', 'Bmin', 'Bmax', 'bur_vol']:
+				assert np.allclose(getattr(ensemble, param), getattr(single, param), atol=0.05)
+
+	def test_aggregates(self, conformers):
+		single, atoms, coords = conformers
+		ensemble = Dbstep.ensemble(atoms, coords, energies=[0.0, 1.0, 100.0], **self.kwargs)
+		assert np.isclose(ensemble.weights.sum(), 1.0) and ensemble.weights[2] < 1e-50
+		assert ensemble.weights[0] / ensemble.weights[1] == pytest.approx(np.exp(1.0 / (0.0019872041 * 298.15)))
+		assert ensemble.min['Bmin'] <= ensemble.mean['Bmin'] <= ensemble.max['Bmin']
+		assert ensemble.boltzmann['L'] == pytest.approx(np.dot(ensemble.weights, ensemble.L))
+		assert Dbstep.ensemble(atoms, coords, **self.kwargs).boltzmann['L'] is None
+
+	def test_steps_of_output_file(self, tmp_path):
+		"""Gaussian output with three geometries, each stretched along x"""
+		mol = parse_data.read_input('dbstep/examples/Et.xyz', '.xyz', Dbstep.set_options({}))
+		lines = [" Entering Gaussian System, Link 0=g16", " Copyright (c) 1988-2019, Gaussian, Inc.  All Rights Reserved."]
+		for n in range(3):
+			coords = mol.CARTESIANS * [1 + 0.1 * n, 1, 1]
+			lines += ["                         Standard orientation:", " " + "-" * 69,
+				" Center     Atomic      Atomic             Coordinates (Angstroms)",
+				" Number     Number       Type             X           Y           Z", " " + "-" * 69]
+			lines += [" {:6d} {:10d} {:11d} {:15.6f} {:11.6f} {:11.6f}".format(i + 1, periodic_table.index(atom), 0, *xyz) 
+				for i, (atom, xyz) in enumerate(zip(mol.ATOMTYPES, coords))]
+			lines += [" " + "-" * 69]
+			(tmp_path / 'step_{}.xyz'.format(n)).write_text("{}\n\n".format(len(coords)) + "".join(
+				"{} {:.6f} {:.6f} {:.6f}\n".format(atom, *xyz) for atom, xyz in zip(mol.ATOMTYPES, coords)))
+		(tmp_path / 'opt.log').write_text("\n".join(lines) + "\n")
+
+		steps = Dbstep.ensemble(str(tmp_path / 'opt.log'), steps='0,-1', **self.kwargs)
+		assert steps.labels == ['opt step 0', 'opt step 2']
+		for n, step in zip([0, 2], steps.conformers):
+			expected = Dbstep.dbstep(str(tmp_path / 'step_{}.xyz'.format(n)), **self.kwargs)
+			for param in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+				assert getattr(step, param) == getattr(expected, param)
+		# a step's values do not depend on which other steps are selected
+		last = Dbstep.ensemble(str(tmp_path / 'opt.log'), steps='-1', **self.kwargs)
+		for param in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+			assert getattr(last, param)[0] == getattr(steps, param)[1]
+
+
+class TestTrajectory:
+	"""Tests trajectory"""
+	kwargs = {'sterimol': True, 'volume': True, 'grid': 0.1, 'commandline': True, 'quiet': True}
+
+	@pytest.mark.parametrize("engine", ['kdtree', 'voxel'])
+	def test_frames_match_single_runs(self, tmp_path, engine):
+		from scipy.spatial.transform import Rotation as R
+		mol = parse_data.read_input('dbstep/examples/Ph.xyz', '.xyz', Dbstep.set_options({}))
+		frames = []
+		with open(tmp_path / 'trajectory.xyz', 'w') as trajectory:
+			for n in range(3):
+				coords = R.from_euler('xyz', [0.1 * n, 0.2 * n, 0.3 * n]).apply(mol.CARTESIANS) * (1 + 0.05 * n)
+				frame = "{}\nframe {}\n".format(len(coords), n) + "".join(
+					"{} {:.6f} {:.6f} {:.6f}\n".format(atom, *xyz) for atom, xyz in zip(mol.ATOMTYPES, coords))
+				(tmp_path / 'frame_{}.xyz'.format(n)).write_text(frame)
+				trajectory.write(frame)
+		results = list(Dbstep.trajectory(str(tmp_path / 'trajectory.xyz'), engine=engine, **self.kwargs))
+		assert len(results) == 3
+		for n, result in enumerate(results):
+			expected = Dbstep.dbstep(str(tmp_path / 'frame_{}.xyz'.format(n)), engine=engine, **self.kwargs)
+			for param in ['L', 'Bmin', 'Bmax', 'bur_vol', 'bur_shell']:
+				assert getattr(result, param) == getattr(expected, param)
+
+
+class TestMultisite:
+	"""Tests multisite"""
+	file = 'dbstep/examples/CHiPr2.xyz'
+	kwargs = {'grid': 0.1, 'commandline': True, 'quiet': True}
+
+	@pytest.mark.parametrize("extra, sites", [
+		({'sterimol': True, 'volume': True}, [(1, 2), (1, '3'), (2, [1, 3]), (4, 6, 10)]), 
+		({'sterimol': True, 'noH': True}, [(2, 4), (4, 2), (4, [6, 10])]), 
+		({'volume': True}, [(1, 2), (1, 3), (4, 6, 10)])])
+	def test_sites_match_single_runs(self, extra, sites):
+		result = Dbstep.multisite(self.file, sites, **self.kwargs, **extra)
+		for n, (atom1, atom2, *atom3) in enumerate(sites):
+			atom2 = ','.join(str(atom) for atom in atom2) if isinstance(atom2, list) else str(atom2)
+			atom3 = atom3[0] if atom3 else False
+			expected = Dbstep.dbstep(self.file, atom1=atom1, atom2=atom2, atom3=atom3, **self.kwargs, **extra)
+			for param in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+				assert getattr(result.results[n], param) == getattr(expected, param)
+				if getattr(expected, param) is not False:
+					assert getattr(result, param)[n] == getattr(expected, param)
+
+	def test_sites_share_frames(self):
+		volume = Dbstep.multisite(self.file, '1:2;1:3;2:1', volume=True, **self.kwargs)
+		assert volume.sites == [(1, [2], False), (1, [3], False), (2, [1], False)]
+		assert volume.results[0] is volume.results[1] and volume.results[0] is not volume.results[2]
+		sterimol = Dbstep.multisite(self.file, '1:2;1:3;1:2', sterimol=True, **self.kwargs)
+		assert sterimol.results[0] is sterimol.results[2] and sterimol.results[0] is not sterimol.results[1]
+
+
+def write_density_cube(path, xyz='dbstep/examples/Et.xyz', spacing=0.25, pad=2.5):
+	"""Writes a cube file of a sum of atom centred Gaussians for the molecule in an xyz file."""
+	mol = parse_data.XYZParser(xyz, 'xyz', False, False, 1, [2])
+	numbers = [periodic_table.index(atom) for atom in mol.ATOMTYPES]
+	coords, step = np.asarray(mol.CARTESIANS) / 0.529177249, spacing / 0.529177249
+	lo = coords.min(axis=0) - pad / 0.529177249
+	dims = np.ceil((coords.max(axis=0) - lo + pad / 0.529177249) / step).astype(int) + 1
+	points = np.stack(np.meshgrid(*[lo[i] + step * np.arange(dims[i]) for i in range(3)], indexing='ij'), axis=-1)
+	density = sum(n * np.exp(-1.2 * np.sum((points - c) ** 2, axis=-1)) for n, c in zip(numbers, coords))
+	lines = [" test cube", " density", "{:5d} {:11.6f} {:11.6f} {:11.6f}    1".format(len(numbers), *lo)]
+	lines += ["{:5d} {:11.6f} {:11.6f} {:11.6f}".format(dim, *np.eye(3)[i] * step) for i, dim in enumerate(dims)]
+	lines += ["{:5d} {:11.6f} {:11.6f} {:11.6f} {:11.6f}".format(n, float(n), *c) for n, c in zip(numbers, coords)]
+	for row in density.reshape(-1, dims[2]):
+		lines += ["".join(" {:12.5E}".format(value) for value in row[n:n + 6]) for n in range(0, len(row), 6)]
+	path.write_text("\n".join(lines) + "\n")
+
+
+def test_cube_written_for_visualization_only(tmp_path):
+	cube = tmp_path / 'Et.cube'
+	write_density_cube(cube)
+	Dbstep.dbstep(str(cube), surface='density', volume=True, commandline=True, quiet=True)
+	assert not (tmp_path / 'Et_radius.cube').exists()
+	Dbstep.dbstep(str(cube), surface='density', volume=True, quiet=True)
+	written, original = (tmp_path / 'Et_radius.cube').read_bytes().splitlines(), cube.read_bytes().splitlines()
+	assert len(written) == len(original) and written[:2] == original[:2] and written[16:] == original[16:]
+	assert (tmp_path / 'Et_steric.py').exists()
+
+
+class TestIsoscan:
+	"""Tests the isovalue scan of a density cube"""
+	kwargs = {'surface': 'density', 'commandline': True, 'quiet': True}
+
+	@pytest.mark.parametrize("extra", [{'sterimol': True, 'volume': True}, {'volume': True, 'vshell': 0.5}, {'sterimol': True, 'boundary': True}])
+	def test_isovalues_match_single_runs(self, tmp_path, extra):
+		cube = tmp_path / 'Et.cube'
+		write_density_cube(cube)
+		scan = Dbstep.dbstep(str(cube), isoscan='0.002:0.042:0.01', **self.kwargs, **extra)
+		assert np.allclose(scan.isovals, [0.002, 0.012, 0.022, 0.032, 0.042]) and len(scan.rows) == 5
+		for n, isoval in enumerate(scan.isovals):
+			expected = Dbstep.dbstep(str(cube), isoval=isoval, **self.kwargs, **extra)
+			for param in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+				if getattr(expected, param) is not False:
+					assert getattr(scan, param)[n] == getattr(expected, param)
+
+	def test_needs_density(self):
+		with pytest.raises(SystemExit):
+			Dbstep.dbstep('dbstep/examples/Et.xyz', isoscan='0.002:0.01:0.002', volume=True, commandline=True, quiet=True)
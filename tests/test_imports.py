@@ -0,0 +1,30 @@
+import subprocess
+import sys
+
+import pytest
+
+
+HEAVY = ['numba', 'cclib', 'scipy.spatial', 'pandas', 'rdkit', 'pkg_resources']
+
+
+def loaded_modules(code):
+	"""Runs code in a fresh interpreter and returns which of the heavy dependencies it imported."""
+	check = code + "\nimport sys\nprint('loaded:' + ','.join(m for m in {} if m in sys.modules))".format(HEAVY)
+	out = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True)
+	return [m for m in out.stdout.strip().splitlines()[-1][len('loaded:'):].split(',') if m]
+
+
+@pytest.mark.parametrize("code", [
+	"import dbstep.Dbstep",
+	"import dbstep",
+	"import sys\nsys.argv = ['dbstep', '--help']\nimport dbstep.Dbstep\ntry: dbstep.Dbstep.main()\nexcept SystemExit: pass",
+])
+def test_import_defers_heavy_dependencies(code):
+	assert loaded_modules(code) == []
+
+
+def test_xyz_run_does_not_load_cclib():
+	code = ("import io, contextlib\nfrom dbstep.Dbstep import dbstep\n"
+		"with contextlib.redirect_stdout(io.StringIO()):\n"
+		"	dbstep('dbstep/examples/Et.xyz', atom1=1, atom2=2, sterimol=True, commandline=True, measure='classic')")
+	assert 'cclib' not in loaded_modules(code)
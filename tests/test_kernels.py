@@ -0,0 +1,75 @@
+import math
+import os
+import subprocess
+import sys
+
+import pytest
+
+import numpy as np
+
+from dbstep import kernels
+
+
+@pytest.fixture
+def points():
+	rng = np.random.default_rng(0)
+	return kernels.as_points(rng.uniform(-3.0, 3.0, (2000, 3)))
+
+
+def test_angular_sweep_matches_loop(points):
+	angles = np.linspace(-math.pi, math.pi, 361)
+	expected = []
+	for angle in angles:
+		rmax = 0.0
+		for x, y, z in points:
+			r = x * math.cos(angle) + y * math.sin(angle)
+			if r > rmax:
+				rmax = r
+		expected.append(rmax)
+	assert np.array_equal(kernels.angular_sweep(points, angles), expected)
+	assert np.allclose(kernels._numpy_angular_sweep(points, angles), expected, rtol=0, atol=1e-12)
+
+
+def test_angular_sweep_of_points_behind_origin():
+	points = kernels.as_points([[-1.0, 0.0, 0.0]])
+	rmax = kernels.angular_sweep(points, np.array([0.0, math.pi]))
+	assert rmax[0] == 0.0
+	assert rmax[1] == pytest.approx(1.0)
+
+
+def test_distance_kernels_match_numpy(points):
+	center = np.array([0.3, -0.2, 0.1])
+	assert np.array_equal(kernels.sq_distances(points, center), kernels._numpy_sq_distances(points, center))
+	for r in [0.0, 1.0, 2.5, 10.0]:
+		assert kernels.count_within(points, center, r ** 2) == kernels._numpy_count_within(points, center, r ** 2)
+
+
+def test_strip_matches_numpy(points):
+	for lo, hi in [(-0.5, 0.5), (1.0, 1.2), (5.0, 6.0)]:
+		assert np.array_equal(kernels.strip(points, lo, hi), kernels._numpy_strip(points, lo, hi))
+
+
+@pytest.mark.parametrize("default", [0, None])
+def test_set_threads_and_warmup(default):
+	kernels.warmup()
+	if kernels.backend() is not kernels._numpy_kernels:
+		import numba
+		start = numba.config.NUMBA_NUM_THREADS
+	kernels.set_threads(1)
+	kernels.warmup()
+	if kernels.backend() is not kernels._numpy_kernels:
+		assert numba.get_num_threads() == 1
+		# 0 or None goes back to the default after an earlier count, e.g. of a previous request
+		kernels.set_threads(default)
+		assert numba.get_num_threads() == kernels.backend().DEFAULT_THREADS == start
+
+
+@pytest.mark.skipif(not kernels.HAVE_NUMBA, reason="numba is not installed")
+def test_dbstep_keeps_thread_count():
+	# in a new interpreter, numba's largest thread count is fixed when it starts
+	code = ("from dbstep import Dbstep, kernels; kernels.set_threads(2); "
+		"Dbstep.dbstep('dbstep/examples/Et.xyz', sterimol=True, volume=True, commandline=True, quiet=True); "
+		"print(kernels.get_threads())")
+	result = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, NUMBA_NUM_THREADS='4'),
+		capture_output=True, text=True, check=True)
+	assert result.stdout.split()[-1] == '2'
@@ -1,6 +1,9 @@
+import os
+
 import pytest
+import numpy as np
 
-from dbstep import parse_data, Dbstep
+from dbstep import parse_data, Dbstep, writer
 
 
 def get_options(noH=False):
@@ -21,3 +24,109 @@ xyz_dir = 'dbstep/examples/'
 def test_read_input_len(molecule, ext, expected_len, options):
 	parser = parse_data.read_input(molecule, ext, options)
 	assert len(parser.ATOMTYPES) == len(parser.CARTESIANS) == expected_len
+
+
+def test_iter_xyz_frames(tmp_path):
+	lines = open(xyz_dir + "Et.xyz").read().splitlines()
+	n_atoms = int(lines[0])
+	frame = "\n".join(lines[:2 + n_atoms]) + "\n"
+	trajectory = tmp_path / "trajectory.xyz"
+	trajectory.write_text(frame + "\n" + frame + frame)
+	mol = parse_data.read_input(xyz_dir + "Et.xyz", ".xyz", get_options())
+
+	frames = list(parse_data.iter_xyz_frames(str(trajectory)))
+	assert len(frames) == 3
+	for comment, atoms, coords in frames:
+		assert atoms == list(mol.ATOMTYPES)
+		assert np.array_equal(coords, mol.CARTESIANS)
+
+	trajectory.write_text(frame + "\n".join(lines[:n_atoms]))
+	with pytest.raises(SystemExit):
+		list(parse_data.iter_xyz_frames(str(trajectory)))
+
+
+@pytest.mark.parametrize("steps, expected", [
+		('all', [0, 1, 2, 3, 4]),
+		('0,-1', [0, 4]),
+		('1:4', [1, 2, 3]),
+		('::2', [0, 2, 4]),
+		(-2, [3]),
+		([2, 0], [2, 0]),
+	])
+def test_select_steps(steps, expected):
+	assert parse_data.select_steps(5, steps) == expected
+
+
+@pytest.mark.parametrize("steps", ['5', '7:9', 'last'])
+def test_select_steps_invalid(steps):
+	with pytest.raises(SystemExit):
+		parse_data.select_steps(5, steps)
+
+
+def write_cube(path, dims=(3, 4, 5)):
+	"""Writes a small cube file of two atoms and returns its density values in file order."""
+	density = np.arange(np.prod(dims)) * 0.5
+	lines = [" test cube", " density", "    2    0.000000    0.000000    0.000000    1"]
+	lines += ["{:5d} {:11.6f} {:11.6f} {:11.6f}".format(dim, *np.eye(3)[i] * 0.2) for i, dim in enumerate(dims)]
+	lines += ["    6    6.000000    0.000000    0.000000    0.000000", "    1    1.000000    0.000000    0.000000    2.000000"]
+	for row in density.reshape(-1, dims[2]):
+		lines += ["".join(" {:12.5E}".format(value) for value in row[n:n + 6]) for n in range(0, len(row), 6)]
+	path.write_text("\n".join(lines) + "\n")
+	return density
+
+
+def test_cube_parser(tmp_path):
+	cube = tmp_path / "test.cube"
+	density = write_cube(cube)
+	mol = parse_data.CubeParser(str(cube), "cube")
+	assert list(mol.ATOMTYPES) == ['C', 'H'] and mol.HEADER_LINES == 8
+	assert (mol.xdim, mol.ydim, mol.zdim) == (3, 4, 5)
+	assert np.array_equal(mol.DENSITY, density) and mol.DATA.shape == (3, 4, 5)
+	assert not hasattr(mol, 'DENSITY_LINE')
+	# the volumetric data of the cube written for PyMOL is copied from the original
+	writer.WriteCubeData(str(tmp_path / "test"), mol)
+	assert (tmp_path / "test_radius.cube").read_text().splitlines()[8:] == cube.read_text().splitlines()[8:]
+
+	cube.write_text(cube.read_text() + " 1.0\n")
+	with pytest.raises(SystemExit):
+		parse_data.CubeParser(str(cube), "cube")
+
+
+def test_cube_parser_mmap_sidecar(tmp_path):
+	cube = tmp_path / "test.cube"
+	write_cube(cube)
+	first = parse_data.CubeParser(str(cube), "cube", mmap=True)
+	assert (tmp_path / "test.cube.npy").exists()
+	second = parse_data.CubeParser(str(cube), "cube", mmap=True)
+	assert isinstance(second.DENSITY, np.memmap)
+	assert np.array_equal(first.DENSITY, second.DENSITY)
+
+	# a cube file newer than its sidecar is read again
+	density = write_cube(cube, dims=(2, 2, 2))
+	sidecar = tmp_path / "test.cube.npy"
+	os.utime(sidecar, (os.path.getmtime(cube) - 10, os.path.getmtime(cube) - 10))
+	third = parse_data.CubeParser(str(cube), "cube", mmap=True)
+	assert np.array_equal(third.DENSITY, density)
+
+
+@pytest.mark.parametrize("suffix, module", [(".gz", "gzip"), (".bz2", "bz2"), (".xz", "lzma")])
+def test_compressed_inputs(tmp_path, monkeypatch, suffix, module):
+	import importlib
+	compress = importlib.import_module(module).compress
+	cube = tmp_path / "test.cube"
+	density = write_cube(cube, dims=(4, 5, 7))
+	(tmp_path / ("test.cube" + suffix)).write_bytes(compress(cube.read_bytes()))
+	assert parse_data.split_ext(str(tmp_path / ("test.cube" + suffix))) == (str(tmp_path / "test"), ".cube")
+	# parsed a few lines at a time
+	monkeypatch.setattr(parse_data, "DENSITY_BLOCK", 100)
+	mol = parse_data.CubeParser(str(tmp_path / ("test.cube" + suffix)), "cube")
+	assert np.array_equal(mol.DENSITY, density) and list(mol.ATOMTYPES) == ['C', 'H']
+	writer.WriteCubeData(str(tmp_path / "test"), mol)
+	assert (tmp_path / "test_radius.cube").read_text().splitlines()[8:] == cube.read_text().splitlines()[8:]
+
+	xyz = tmp_path / ("Et.xyz" + suffix)
+	with open(xyz_dir + "Et.xyz", "rb") as f:
+		xyz.write_bytes(compress(f.read()))
+	mol = parse_data.read_input(str(xyz), ".xyz", get_options())
+	assert len(mol.ATOMTYPES) == 8
+	assert [len(atoms) for comment, atoms, coords in parse_data.iter_xyz_frames(str(xyz))] == [8]
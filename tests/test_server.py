@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dbstep import Dbstep, parse_data, server, kernels
+
+
+xyz_dir = 'dbstep/examples/'
+options = {'sterimol': True, 'volume': True, 'grid': 0.1}
+
+
+def test_handle_file_and_inline_coordinates():
+	expected = Dbstep.dbstep(xyz_dir + 'Et.xyz', commandline=True, quiet=True, **options)
+	mol = parse_data.read_input(xyz_dir + 'Et.xyz', '.xyz', Dbstep.set_options({}))
+	requests = [{'id': 'file', 'file': xyz_dir + 'Et.xyz', 'options': options},
+		{'id': 'inline', 'atoms': list(mol.ATOMTYPES), 'coords': mol.CARTESIANS.tolist(), 'options': options}]
+	for request in requests:
+		response = server.handle(request)
+		assert response['id'] == request['id'] and response['error'] is None
+		for attribute in ['L', 'Bmin', 'Bmax', 'occ_vol', 'bur_vol', 'bur_shell']:
+			assert response['results'][attribute] == getattr(expected, attribute)
+		assert 'Bmin' in response['output']
+
+
+def test_serve_stream_reports_bad_requests():
+	lines = ['{"id": 1, "file": "%sEt.xyz", "options": {"grid": 0.1, "sterimol": true}}\n' % xyz_dir, 'not json\n', '\n',
+		'{"id": 2, "file": "missing.xyz"}\n', '{"id": 3, "options": {}}\n']
+	out = io.StringIO()
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		server.serve_stream(executor, lines, out.write)
+	responses = {response['id']: response for response in map(json.loads, out.getvalue().splitlines())}
+	assert len(responses) == 4
+	assert responses[1]['error'] is None and responses[1]['results']['L'] > 0
+	assert 'invalid JSON' in responses[None]['error']
+	assert 'missing.xyz' in responses[2]['error']
+	assert 'needs a "file"' in responses[3]['error']
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="Unix sockets are not available")
+def test_socket_server(tmp_path):
+	path = str(tmp_path / 'dbstep.sock')
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		unix_server = server.make_server(path, executor)
+		thread = threading.Thread(target=unix_server.serve_forever)
+		thread.start()
+		try:
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+				client.connect(path)
+				for n, name in enumerate(['Et.xyz', 'Ph.xyz']):
+					request = {'id': n, 'file': xyz_dir + name, 'options': {'grid': 0.1, 'sterimol': True}}
+					client.sendall((json.dumps(request) + '\n').encode())
+				client.shutdown(socket.SHUT_WR)
+				responses = [json.loads(line) for line in client.makefile().read().splitlines()]
+		finally:
+			unix_server.shutdown()
+			unix_server.server_close()
+			thread.join()
+	assert sorted(response['id'] for response in responses) == [0, 1]
+	assert all(response['error'] is None for response in responses)
+
+
+@pytest.mark.skipif(not kernels.HAVE_NUMBA, reason="numba is not installed")
+def test_workers_keep_thread_count(monkeypatch):
+	# spawned workers start numba with 4 threads, set to 2 for the server
+	monkeypatch.setenv('NUMBA_NUM_THREADS', '4')
+	executor, defaults = server.make_executor(2, 2)
+	with executor:
+		assert defaults['threads'] == 2
+		request = {'id': 1, 'file': xyz_dir + 'Et.xyz', 'options': options}
+		assert all(response['error'] is None for response in executor.map(server.handle, [request] * 4, [defaults] * 4))
+		assert [future.result() for future in [executor.submit(kernels.get_threads) for n in range(4)]] == [2] * 4
+
+
+@pytest.mark.skipif(not kernels.HAVE_NUMBA, reason="numba is not installed")
+def test_single_worker_keeps_thread_count():
+	# in a new interpreter, numba's largest thread count is fixed when it starts
+	code = ("from dbstep import server, kernels; executor, defaults = server.make_executor(1, 2); "
+		"print(executor.submit(server.handle, {'file': 'dbstep/examples/Et.xyz'}, defaults).result()['error'], kernels.get_threads())")
+	result = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, NUMBA_NUM_THREADS='4'),
+		capture_output=True, text=True, check=True)
+	assert result.stdout.split()[-2:] == ['None', '2']
@@ -0,0 +1,234 @@
+import pytest
+
+import numpy as np
+
+from dbstep import sterics, parse_data, calculator, Dbstep
+from dbstep.constants import bondi
+
+
+xyz_dir = 'dbstep/examples/'
+
+
+def get_options(**kwargs):
+	"""Makes a mini options object."""
+	kwargs.setdefault('atom1', 1)
+	kwargs.setdefault('atom2', [2])
+	kwargs.setdefault('grid', 0.1)
+	return Dbstep.set_options(kwargs)
+
+
+@pytest.fixture(params=['Et.xyz', 'CHiPr2.xyz', 'Ph.xyz'])
+def grid_setup(request):
+	"""Parsed molecule translated to the origin with the axis values of its grid."""
+	options = get_options()
+	mol = parse_data.read_input(xyz_dir + request.param, '.xyz', options)
+	mol.RADII = np.array([bondi[atom] for atom in mol.ATOMTYPES])
+	mol.CARTESIANS = calculator.translate_mol(mol, options, np.array([0, 0, 0]))
+	x_min, x_max, y_min, y_max, z_min, z_max, xyz_max = sterics.max_dim(mol.CARTESIANS, mol.RADII, options)
+	axes = [
+		np.linspace(lo, hi, int(1 + round((hi - lo) / options.grid)))
+		for lo, hi in [(x_min, x_max), (y_min, y_max), (z_min, z_max)]]
+	return mol, axes, options
+
+
+def test_voxel_grid_points_match_meshgrid(grid_setup):
+	mol, axes, options = grid_setup
+	grid = np.array(np.meshgrid(*axes)).T.reshape(-1,3)
+	assert np.array_equal(sterics.VoxelGrid(*axes).points(), grid)
+
+
+def test_voxel_indices_are_compact(grid_setup):
+	mol, axes, options = grid_setup
+	occ_index, voxel, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, np.array([0, 0, 0]), options)
+	assert occ_index.dtype == np.int16
+	assert np.array_equal(voxel.cartesians(occ_index), voxel.occupied_points())
+	assert np.array_equal(voxel.cartesians(occ_index), voxel.points()[voxel.flat_mask()])
+	assert sterics.VoxelGrid(np.arange(40000), [0.], [0.]).index_dtype == np.int32
+
+
+def test_occupied_voxel_matches_kdtree(grid_setup):
+	mol, axes, options = grid_setup
+	origin = np.array([0, 0, 0])
+	grid = np.array(np.meshgrid(*axes)).T.reshape(-1,3)
+	occ_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
+	vox_index, voxel, vox_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, origin, options)
+	vox_grid = voxel.cartesians(vox_index)
+
+	assert occ_vol == vox_vol
+	assert set(map(tuple, occ_grid)) == set(map(tuple, vox_grid))
+	for rad, strip_width in [(3.5, 0.0), (2.0, 0.5), (0.4, 0.5)]:
+		expected = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options)
+		actual = sterics.buried_vol(vox_grid, voxel, origin, rad, strip_width, options)
+		assert expected == actual
+
+
+def test_reused_voxel_grid_matches_new(grid_setup):
+	mol, axes, options = grid_setup
+	origin = np.array([0, 0, 0])
+	expected, new_voxel, expected_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, origin, options)
+	# a grid left occupied by a different (larger) set of axes is cleared and its memory reused
+	voxel = sterics.VoxelGrid(*[np.append(vals, vals[-1] + options.grid) for vals in axes])
+	voxel.mask[...] = True
+	buffer = voxel._buffer
+	occ_index, reused, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, origin, options, voxel)
+	assert reused is voxel and voxel._buffer is buffer
+	assert np.array_equal(occ_index, expected) and occ_vol == expected_vol
+	assert np.array_equal(voxel.mask, new_voxel.mask)
+
+
+def test_occupied_dens_axis_order():
+	"""Density of a sphere away from the origin, stored in cube order (x slowest, z fastest)"""
+	options = get_options(isoval=0.5)
+	x_vals, y_vals, z_vals = np.linspace(-2, 2, 21), np.linspace(-1, 3, 21), np.linspace(0, 2, 11)
+	center, radius = np.array([1.0, 2.0, 0.6]), 0.7
+	points = np.array([[x, y, z] for x in x_vals for y in y_vals for z in z_vals])
+	dens = (np.linalg.norm(points - center, axis=1) < radius).astype(float)
+
+	occ_index, voxel, occ_vol = sterics.occupied_dens(x_vals, y_vals, z_vals, dens, options)
+	assert set(map(tuple, voxel.cartesians(occ_index))) == set(map(tuple, points[dens > 0.5]))
+	assert occ_vol == np.count_nonzero(dens) * options.grid ** 3
+	# voxels in a sphere are counted from the mask, as a KD-tree query over every grid point would
+	from scipy import spatial
+	for R in [0.5, 1.0, 2.5]:
+		assert voxel.count(center, R) == len(spatial.cKDTree(points).query_ball_point(center, R))
+		assert voxel.count(center, R, occupied=True) == len(spatial.cKDTree(points[dens > 0.5]).query_ball_point(center, R))
+
+
+def test_qsar_partition_matches_voxel(grid_setup):
+	"""Occupied and unoccupied grid points and the one-hot vector of the KD-tree and voxel engines agree"""
+	mol, axes, options = grid_setup
+	options.qsar = True
+	origin = np.array([0, 0, 0])
+	grid = np.array(np.meshgrid(*axes)).T.reshape(-1,3)
+	occ_grid, unocc_grid, onehot, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
+	occ_index, voxel_unocc, voxel_onehot, voxel, voxel_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, origin, options)
+	assert np.array_equal(onehot, voxel_onehot) and occ_vol == voxel_vol
+	assert np.array_equal(occ_grid, grid[onehot == 1]) and np.array_equal(unocc_grid, grid[onehot == 0])
+	assert np.array_equal(unocc_grid, voxel_unocc) and len(occ_grid) + len(unocc_grid) == len(grid)
+
+
+@pytest.mark.parametrize("sterimol, radius", [(True, None), (False, 1.0), (True, 1.0)])
+def test_occupied_dens_cropped(sterimol, radius):
+	"""The cropped grid keeps every occupied voxel (Sterimol) and every voxel within radius (buried volume)"""
+	options = get_options(isoval=0.5, sterimol=sterimol)
+	x_vals, y_vals, z_vals = np.linspace(-2, 2, 41), np.linspace(-2, 2, 41), np.linspace(-1, 3, 41)
+	points = np.array([[x, y, z] for x in x_vals for y in y_vals for z in z_vals])
+	dens = (np.linalg.norm(points - np.array([0.2, 0.0, 0.8]), axis=1) < 0.6).astype(float)
+
+	occ_index, voxel, occ_vol = sterics.occupied_dens(x_vals, y_vals, z_vals, dens, options, radius)
+	assert voxel.size < len(points)
+	assert occ_vol == np.count_nonzero(dens) * options.grid ** 3
+	if sterimol:
+		assert set(map(tuple, voxel.cartesians(occ_index))) == set(map(tuple, points[dens > 0.5]))
+	if radius is not None:
+		from scipy import spatial
+		for R in [0.5, radius]:
+			assert voxel.count(np.zeros(3), R) == len(spatial.cKDTree(points).query_ball_point(np.zeros(3), R))
+			assert voxel.count(np.zeros(3), R, occupied=True) == len(spatial.cKDTree(points[dens > 0.5]).query_ball_point(np.zeros(3), R))
+
+
+@pytest.mark.parametrize("engine", ['kdtree', 'voxel'])
+def test_radial_counts_match_buried_vol(grid_setup, engine):
+	mol, axes, options = grid_setup
+	origin = np.array([0, 0, 0])
+	if engine == 'voxel':
+		occ_grid, point_tree, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, origin, options)
+	else:
+		grid = np.array(np.meshgrid(*axes)).T.reshape(-1,3)
+		occ_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, origin, options)
+	strip_width = 0.25
+	counts = sterics.RadialCounts(occ_grid, point_tree, origin, 3.5 + 0.5 * strip_width)
+	for rad in np.linspace(0.25, 3.5, 14):
+		expected = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options)
+		actual = sterics.buried_vol(occ_grid, point_tree, origin, rad, strip_width, options, counts)
+		assert expected == actual
+
+
+@pytest.mark.parametrize("R, strip_width, measure_pos", [(0.0, 0.0, False), (1.5, 0.5, False), (0.0, 0.0, True)])
+def test_hull_sterimol_against_sweep(grid_setup, R, strip_width, measure_pos):
+	"""The exact hull Bmin can only be at or below the 1 degree sweep, Bmax and L are unchanged."""
+	mol, axes, options = grid_setup
+	occ_index, voxel, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, np.array([0, 0, 0]), options)
+	occ_grid = voxel.cartesians(occ_index)
+	L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(occ_grid, R, options.grid, strip_width, measure_pos)
+	hull_L, hull_Bmax, hull_Bmin, hull_cyl = sterics.get_cube_sterimol(occ_grid, R, options.grid, strip_width, measure_pos, hull=True)
+
+	assert hull_L == L
+	assert hull_Bmax == Bmax
+	assert Bmin - 0.02 <= hull_Bmin <= Bmin
+	assert len(hull_cyl) == len(cyl)
+
+
+def test_hull_bmin_is_exact():
+	"""A square centred on the origin has its smallest support along the edge normals."""
+	square = np.array([[-1., -1.], [1., -1.], [1., 1.], [-1., 1.]])
+	hull = sterics.convex_hull_2d(np.vstack((square, [[0., 0.], [0.5, -0.5], [1., 0.]])))
+	Bmin, phi = sterics.hull_bmin(hull)
+	assert len(hull) == 4
+	assert Bmin == pytest.approx(1.0)
+	assert np.isclose(np.cos(phi) ** 2, 1.0) or np.isclose(np.sin(phi) ** 2, 1.0)
+
+
+@pytest.mark.parametrize("x_range", [(1.0, 2.0), (0.0, 2.0)])
+def test_hull_sterimol_origin_outside_hull(x_range):
+	"""A slice to one side of the L-axis (origin outside or on its projected hull) gives the swept Bmin."""
+	x, y = np.meshgrid(np.arange(x_range[0], x_range[1] + 0.05, 0.1), np.arange(-1.0, 1.05, 0.1))
+	points = np.column_stack((x.ravel(), y.ravel(), np.full(x.size, 0.5)))
+	assert sterics.hull_bmin(sterics.convex_hull_2d(points[:,:2])) == (None, None)
+	L, Bmax, Bmin, cyl = sterics.get_cube_sterimol(points, 0.0, 0.1, 0.0)
+	hull_L, hull_Bmax, hull_Bmin, hull_cyl = sterics.get_cube_sterimol(points, 0.0, 0.1, 0.0, hull=True)
+	assert Bmin < 0.1 and hull_Bmin == Bmin
+	assert hull_L == L and hull_Bmax == pytest.approx(Bmax)
+
+
+@pytest.mark.parametrize("name", ['Ad.xyz', 'CHiPr2.xyz', 'tBu.xyz', '4MeOPh.xyz'])
+def test_classic_sterimol_increments_and_exact_bmin(name):
+	"""Sweeps approach the exact B1 from above, the exact value is never above any sweep."""
+	options = get_options()
+	mol = parse_data.read_input(xyz_dir + name, '.xyz', options)
+	radii = np.array([bondi[atom] for atom in mol.ATOMTYPES])
+	coords = calculator.translate_mol(mol, options, np.array([0, 0, 0]))
+	coords = calculator.rotate_mol(coords, 1, calculator.point_vec(coords, [2]))
+
+	L, Bmax, Bmin, cyl = sterics.get_classic_sterimol(coords, radii, mol.ATOMTYPES)
+	fine_L, fine_Bmax, fine_Bmin, fine_cyl = sterics.get_classic_sterimol(coords, radii, mol.ATOMTYPES, 6000)
+	exact_L, exact_Bmax, exact_Bmin, exact_cyl = sterics.get_classic_sterimol(coords, radii, mol.ATOMTYPES, hull=True)
+
+	assert L == fine_L == exact_L
+	assert Bmax == fine_Bmax == exact_Bmax
+	assert exact_Bmin <= fine_Bmin and exact_Bmin <= Bmin
+	assert fine_Bmin - exact_Bmin < 1e-3
+
+
+@pytest.mark.parametrize("measure_pos", [False, True])
+def test_z_sorted_strips_match_unsorted(grid_setup, measure_pos):
+	mol, axes, options = grid_setup
+	grid = np.array(np.meshgrid(*axes)).T.reshape(-1,3)
+	occ_grid, point_tree, occ_vol = sterics.occupied(grid, mol.CARTESIANS, mol.RADII, np.array([0, 0, 0]), options)
+	sorted_grid, z_index = sterics.sort_z(occ_grid)
+	for R in np.linspace(-1.0, 6.0, 15):
+		expected = sterics.get_cube_sterimol(occ_grid, R, options.grid, 0.25, measure_pos)
+		actual = sterics.get_cube_sterimol(sorted_grid, R, options.grid, 0.25, measure_pos, z_index=z_index)
+		assert expected[:3] == actual[:3]
+
+
+def test_boundary_points_match_between_engines(grid_setup):
+	mol, axes, options = grid_setup
+	occ_index, voxel, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, np.array([0, 0, 0]), options)
+	occ_grid = voxel.cartesians(occ_index)
+	from_mask = voxel.boundary_points()
+	from_points = sterics.boundary_points(occ_grid)
+	assert set(map(tuple, from_mask)) == set(map(tuple, from_points))
+	assert len(from_mask) < len(occ_grid)
+
+
+@pytest.mark.parametrize("hull", [False, True])
+@pytest.mark.parametrize("R, strip_width, measure_pos", [
+	(0.0, 0.0, False), (0.5, 0.25, False), (2.0, 0.25, False), (3.5, 0.5, False), (0.0, 0.0, True)])
+def test_boundary_sterimol_identical_to_full_grid(grid_setup, R, strip_width, measure_pos, hull):
+	mol, axes, options = grid_setup
+	occ_index, voxel, occ_vol = sterics.occupied_voxel(*axes, mol.CARTESIANS, mol.RADII, np.array([0, 0, 0]), options)
+	occ_grid = voxel.cartesians(occ_index)
+	expected = sterics.get_cube_sterimol(occ_grid, R, options.grid, strip_width, measure_pos, hull)
+	actual = sterics.get_cube_sterimol(voxel.boundary_points(), R, options.grid, strip_width, measure_pos, hull)
+	assert expected[:3] == actual[:3]
@@ -0,0 +1,112 @@
+import csv
+import json
+
+import pytest
+
+from dbstep import Dbstep, writer
+
+
+xyz_dir = 'dbstep/examples/'
+
+
+@pytest.fixture(scope='module')
+def results():
+	kwargs = {'sterimol': True, 'grid': 0.1, 'commandline': True, 'quiet': True}
+	return [Dbstep.dbstep(xyz_dir + 'Et.xyz', volume=True, **kwargs), Dbstep.dbstep(xyz_dir + 'Ph.xyz', scan='0:2:1', **kwargs)]
+
+
+def expected_rows(results):
+	return [[str(mol.file), rad, L, Bmin, Bmax, mol.occ_vol, bur_vol, bur_shell] 
+		for mol in results for rad, bur_vol, bur_shell, Bmin, Bmax, L in mol.rows]
+
+
+@pytest.mark.parametrize("suffix", ['csv', 'jsonl'])
+def test_result_sink_rows(tmp_path, results, suffix):
+	path = str(tmp_path / ('results.' + suffix))
+	with writer.ResultSink(path) as sink:
+		for mol in results:
+			sink.add(mol)
+	assert sink.n_rows == 4
+
+	with open(path) as f:
+		if suffix == 'csv':
+			rows = list(csv.DictReader(f))
+		else:
+			rows = [json.loads(line) for line in f]
+	for row, expected in zip(rows, expected_rows(results)):
+		assert row['file'] == expected[0]
+		for column, value in zip(writer.ResultSink.COLUMNS[1:], expected[1:]):
+			if value is False:
+				assert row[column] in ['', None]
+			else:
+				assert float(row[column]) == value
+
+
+def test_result_sink_flushes_every_n_rows(tmp_path, results):
+	path = tmp_path / 'results.jsonl'
+	sink = writer.ResultSink(str(path), flush_every=2)
+	sink.add(results[1])
+	# two rows have been written, the third is still buffered
+	assert len(path.read_text().splitlines()) == 2
+	sink.close()
+	assert len(path.read_text().splitlines()) == 3
+
+
+def test_result_sink_parquet(tmp_path, results):
+	pq = pytest.importorskip('pyarrow.parquet')
+	path = str(tmp_path / 'results.parquet')
+	with writer.ResultSink(path, flush_every=3) as sink:
+		for mol in results:
+			sink.add(mol)
+	table = pq.read_table(path)
+	assert table.column_names == writer.ResultSink.COLUMNS
+	assert table.column('file').to_pylist() == [row[0] for row in expected_rows(results)]
+
+
+def test_qsar_container(tmp_path, monkeypatch):
+	import os, shutil
+	import numpy as np
+	shutil.copy(xyz_dir + 'Et.xyz', tmp_path / 'Et.xyz')
+	monkeypatch.chdir(tmp_path)
+	kwargs = {'qsar': True, 'engine': 'voxel', 'commandline': True, 'quiet': True}
+	files = Dbstep.dbstep('Et.xyz', **kwargs)
+	container = Dbstep.dbstep('Et.xyz', qsarformat='npz', **kwargs)
+	assert container.qsar_file == str(tmp_path / 'grid_Et.npz') and container.qsar_dir is False
+
+	with np.load(container.qsar_file) as grid:
+		assert sorted(grid['atoms']) == ['C', 'C', 'H', 'H', 'H', 'H', 'H', 'H'] and str(grid['probe']) == 'Ar'
+		coords, points = grid['coords'], grid['points']
+	assert np.array_equal(points, container.unocc_grid) and len(points) == len(container.interaction_energy)
+	# the molecule and probe of each grid point are those of its xyz file
+	assert len(os.listdir(files.qsar_dir)) == len(points) + 1
+	lines = open(files.qsar_dir + 'GRIDPOINT_Ar_7.xyz').read().splitlines()
+	assert np.allclose([[float(value) for value in line.split()[1:]] for line in lines[2:-1]], coords, atol=1e-5)
+	assert np.allclose([float(value) for value in lines[-1].split()[1:]], points[7], atol=1e-5)
+
+
+
+def test_qsar_container_slices_are_memory_mapped(tmp_path):
+	import numpy as np
+	from dbstep import parse_data
+	mol = parse_data.ArrayParser(['C', 'H'], [[0.0, 0.0, 0.0], [0.0, 0.0, 1.1]])
+	points = np.random.default_rng(0).uniform(-5, 5, (100000, 3))
+	writer.qsar_export(str(tmp_path / 'grid.npz'), mol, points)
+
+	grid = parse_data.read_qsar_grid(str(tmp_path / 'grid.npz'))
+	# the points are read from the file on demand rather than loaded (or decompressed) as a whole
+	assert isinstance(grid['points'], np.memmap) and grid['points'].shape == (100000, 3)
+	assert np.array_equal(grid['points'][40000:40010], points[40000:40010])
+	assert list(grid['atoms']) == ['C', 'H'] and grid['probe'] == 'Ar'
+	assert np.array_equal(grid['coords'], mol.CARTESIANS) and np.array_equal(grid['reference'], points[-1] + 100)
+	with np.load(str(tmp_path / 'grid.npz')) as stored:
+		assert np.array_equal(stored['points'], points)
+
+def test_onehot_export(tmp_path):
+	import numpy as np
+	from scipy import sparse
+	rows = [[0, 3, 4], [], [1, 4]]
+	matrix = writer.onehot_export(str(tmp_path / 'onehot.npz'), rows, 6)
+	stored = sparse.load_npz(str(tmp_path / 'onehot.npz'))
+	expected = np.array([[1, 0, 0, 1, 1, 0], [0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 1, 0]], dtype=np.int8)
+	assert np.array_equal(stored.toarray(), expected) and np.array_equal(matrix.toarray(), expected)
+	assert stored.shape == (3, 6) and stored.dtype == np.int8